@@ -0,0 +1,41 @@
+"""
+Compares the cost of cmb_utils.find_maxima using the maximum filter and the FFT
+matched filter on synthetic full-sky maps of increasing resolution.
+
+Run from the repository root:
+
+    python benchmarks/find_maxima.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from cmb import cmb_utils, synthetic
+
+# map resolutions in degrees and the hot spot scale the search is tuned for
+RESOLUTIONS = [0.5, 0.25, 0.125, 0.0625]
+HOTSPOT_SIZE = 1.0
+REPEAT = 3
+
+def best_time(fn, repeat=REPEAT):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    print(f"{'shape':>14} {'pixels':>10} {'maximum [s]':>12} {'matched [s]':>12}")
+    for res in RESOLUTIONS:
+        imap = synthetic.synthetic_map(res)
+        # keep the neighborhood at the same size on the sky at every resolution
+        neighborhood_size = int(round(HOTSPOT_SIZE / res))
+        maximum = best_time(lambda: cmb_utils.find_maxima(imap, neighborhood_size))
+        matched = best_time(lambda: cmb_utils.find_maxima(imap, method="matched", fwhm=HOTSPOT_SIZE))
+        shape = "x".join(str(n) for n in imap.shape)
+        print(f"{shape:>14} {imap.size:>10} {maximum:>12.3f} {matched:>12.3f}")
+
+if __name__ == "__main__":
+    main()
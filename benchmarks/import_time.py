@@ -0,0 +1,86 @@
+"""
+Checks the import time of the cmb package against a budget.
+
+Each case imports the package in a fresh interpreter started with `-X importtime`,
+sums the cumulative times of the modules the import statement loaded (the
+interpreter's own startup imports are left out), and checks that none of the heavy
+dependencies, which the package only imports on first use, were loaded. The best of
+`--repeat` runs is kept, to leave out the noise of a cold disk cache.
+
+Run from the repository root:
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --scale 3  # budgets 3 times larger, on a slow machine
+
+Exits with status 1 when a case goes over budget or loads a forbidden module.
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+HEAVY_MODULES = ["pixell", "astropy", "scipy", "matplotlib", "ipywidgets", "IPython"]
+
+# (import statement, budget in milliseconds, top level packages it must not load)
+CASES = [
+    ("import cmb", 20, HEAVY_MODULES + ["numpy"]),
+    # the import cell of the notebooks
+    ("from cmb.i18n import I18N", 50, HEAVY_MODULES + ["numpy"]),
+    ("from cmb import layout, plot, tester, widgets, cmb_utils, const", 400, HEAVY_MODULES),
+]
+
+def import_times(statement):
+    """
+    Runs `statement` in a new interpreter with -X importtime.
+
+    Returns:
+    - Tuple with the cumulative import time (in microseconds) of every top level
+      import the statement made, by module, and the names of all the loaded modules.
+    """
+    script = f"{statement}\nimport sys\nprint(' '.join(sys.modules))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", script], cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # nested imports are indented, top level ones are directly after the separator
+        if name.startswith(" ") and not name.startswith("  ") and cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times, result.stdout.split()
+
+def measure(statement, repeat):
+    """ Best total import time (in milliseconds) of `statement`, and the modules it loaded """
+    startup, _ = import_times("pass")
+    best = None
+    for _ in range(repeat):
+        times, modules = import_times(statement)
+        total = sum(time for name, time in times.items() if name not in startup) / 1e3
+        best = total if best is None else min(best, total)
+    return best, modules
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1, help="factor applied to every budget")
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'statement':<66} {'time [ms]':>10} {'budget [ms]':>12}  forbidden modules loaded")
+    for statement, budget, forbidden in CASES:
+        total, modules = measure(statement, args.repeat)
+        budget *= args.scale
+        loaded = sorted({name.split(".")[0] for name in modules} & set(forbidden))
+        print(f"{statement:<66} {total:>10.1f} {budget:>12.1f}  {', '.join(loaded) or '-'}")
+        failed |= total > budget or bool(loaded)
+
+    if failed:
+        print("import time check failed")
+        sys.exit(1)
+    print("import time check passed")
+
+if __name__ == "__main__":
+    main()
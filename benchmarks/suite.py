@@ -0,0 +1,206 @@
+"""
+Benchmark suite of the cmb_utils, stacking, plot and tester hot paths on synthetic
+maps, so it runs offline without the Planck map under data/.
+
+Every case runs across several map resolutions or catalog sizes. It records the wall
+times of `--repeat` runs, then the peak memory traced by tracemalloc during one more
+run (numpy reports its allocations to tracemalloc). The results are printed as a
+table and written as JSON, to compare scaling curves between releases.
+
+Run from the repository root:
+
+    python benchmarks/suite.py                      # writes benchmarks/results.json
+    python benchmarks/suite.py --quick              # smaller maps and catalogs
+    python benchmarks/suite.py --filter thumbnails --output thumbnails.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+import contextlib
+import tempfile
+import tracemalloc
+import subprocess
+
+import numpy as np
+import ipywidgets
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from cmb import cmb_utils, functions, plot, stacking, synthetic, tester, const
+
+RESOLUTIONS = [0.5, 0.25, 0.125]
+CATALOG_SIZES = [10, 100, 1000]
+QUICK_RESOLUTIONS = [0.5, 0.25]
+QUICK_CATALOG_SIZES = [10, 100]
+# resolution of the map the catalog sized cases extract from
+CATALOG_RESOLUTION = 0.125
+
+def measure(fn, repeat):
+    """ Wall times of `repeat` calls of `fn`, then the peak traced memory of one more """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+        plt.close("all")
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        plt.close("all")
+    return times, peak
+
+class Suite:
+    """ Collects the cases of the benchmark, see `cases` """
+
+    def __init__(self, resolutions, catalog_sizes, repeat, pattern=None):
+        self.resolutions = resolutions
+        self.catalog_sizes = catalog_sizes
+        self.repeat = repeat
+        self.pattern = pattern
+        self.results = []
+        self.maps = {}
+
+    def map(self, res):
+        if res not in self.maps:
+            self.maps[res] = synthetic.synthetic_map(res)
+        return self.maps[res]
+
+    def run(self, name, fn, repeat=None, **params):
+        if self.pattern and self.pattern not in name:
+            return
+        times, peak = measure(fn, repeat or self.repeat)
+        result = {
+            "name": name,
+            "params": params,
+            "times": times,
+            "min": min(times),
+            "median": float(np.median(times)),
+            "peak_bytes": peak,
+        }
+        self.results.append(result)
+        print(f"{name:<36} {json.dumps(params):<32} {result['min'] * 1e3:>10.2f} "
+              f"{result['median'] * 1e3:>10.2f} {peak / 2**20:>10.2f}", flush=True)
+
+def cases(suite, workdir):
+    for res in suite.resolutions:
+        imap = suite.map(res)
+        filename = os.path.join(workdir, f"map_{res}.fits")
+        # the same map, streamed to disk in the layout of the Planck IQU file
+        synthetic.write_synthetic_map(filename, res)
+        stats = cmb_utils.MapStatistics.from_map(imap)
+
+        suite.run("load_cmb_map", lambda: cmb_utils.load_cmb_map(filename, cache=False), res=res)
+        cmb_utils.load_cmb_map(filename)
+        suite.run("load_cmb_map.cached", lambda: cmb_utils.load_cmb_map(filename), res=res)
+        suite.run("map_statistics", lambda: cmb_utils.MapStatistics.from_map(imap), res=res)
+        neighborhood_size = int(round(1 / res))
+        suite.run("find_maxima", lambda: cmb_utils.find_maxima(imap, neighborhood_size), res=res)
+        suite.run("find_maxima.matched", lambda: cmb_utils.find_maxima(imap, method="matched"), res=res)
+        suite.run("plot.planck_map", lambda: plot.planck_map(imap), res=res)
+        suite.run("plot.cmb_std_dev", lambda: plot.cmb_std_dev(imap, True, stats), res=res)
+
+    imap = suite.map(CATALOG_RESOLUTION)
+    for n in suite.catalog_sizes:
+        coords = stacking.random_coords(n, seed=0)
+        # the reference extraction is slow, keep it to a single run on large catalogs
+        repeat = 1 if n > 100 else None
+        suite.run("extract_thumbnails", lambda: cmb_utils.extract_thumbnails(imap, coords, cache=None),
+                  repeat=repeat, n=n)
+        suite.run("extract_thumbnails.batched",
+                  lambda: cmb_utils.extract_thumbnails(imap, coords, cache=None, method="batched"), n=n)
+
+        thumbnails = cmb_utils.extract_thumbnails(imap, coords, cache=None, method="batched")
+        suite.run("radial_profiles", lambda: cmb_utils.radial_profiles(thumbnails), n=n)
+        suite.run("extract_profile", lambda: cmb_utils.extract_profile(thumbnails.mean(0)), n=n)
+        suite.run("fit_gaussians", lambda: cmb_utils.fit_gaussians(thumbnails), n=n)
+
+        def stack():
+            # start cold every run, the stack extracts through the thumbnail cache
+            cmb_utils.thumbnail_cache.clear()
+            thumbnail_stack = stacking.ThumbnailStack(imap)
+            thumbnail_stack.append(coords)
+            return thumbnail_stack.mean()
+
+        suite.run("stacking.ThumbnailStack", stack, repeat=repeat, n=n)
+        suite.run("stacking.stack.median", lambda: stacking.stack(thumbnails, "median"), n=n)
+        suite.run("stacking.stack.clipped", lambda: stacking.stack(thumbnails, "clipped"), n=n)
+        suite.run("stacking.hotspot_size_interval",
+                  lambda: stacking.hotspot_size_interval(thumbnails, seed=0), n=n)
+
+    mean_image = cmb_utils.extract_thumbnails(imap, stacking.random_coords(10, seed=0), cache=None).mean(0)
+    suite.run("plot.view_map_pixel", lambda: plot.view_map_pixel(mean_image))
+    suite.run("plot.averaged_hotspot_radial_profile",
+              lambda: plot.averaged_hotspot_radial_profile(mean_image))
+
+    # the widgets draw into an Output, where the inline backend renders the figure;
+    # render it the same way, what gets displayed is dropped
+    output = ipywidgets.Output()
+    temperatures = itertools.cycle(np.linspace(3000, 10000, 8))
+
+    def blackbody_draw(live_plot, temp):
+        with contextlib.redirect_stdout(io.StringIO()):
+            live_plot.draw(const.wavelengths, "Sun", 5778, temp, functions.blackbody_radiation)
+        live_plot.fig.canvas.draw()
+        return live_plot
+
+    suite.run("plot.BlackbodyPlot.draw", lambda: blackbody_draw(plot.BlackbodyPlot(output), 6000))
+    live_plot = blackbody_draw(plot.BlackbodyPlot(output), 6000)
+    suite.run("plot.BlackbodyPlot.update", lambda: blackbody_draw(live_plot, next(temperatures)))
+    suite.run("plot.blackbody_heatmap", lambda: plot.blackbody_heatmap(const.wavelengths, 6000))
+
+    suite.run("tester.test_blackbody_radiation",
+              lambda: tester.test_blackbody_radiation(functions.blackbody_radiation))
+    suite.run("tester.test_peak_wavelength",
+              lambda: tester.test_peak_wavelength(functions.peak_wavelength))
+
+def metadata():
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.json"))
+    parser.add_argument("--quick", action="store_true", help="smaller maps and catalogs")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--filter", help="only run the cases whose name contains this")
+    args = parser.parse_args()
+
+    suite = Suite(
+        QUICK_RESOLUTIONS if args.quick else RESOLUTIONS,
+        QUICK_CATALOG_SIZES if args.quick else CATALOG_SIZES,
+        args.repeat,
+        args.filter,
+    )
+    print(f"{'case':<36} {'params':<32} {'min [ms]':>10} {'median [ms]':>10} {'peak [MB]':>10}")
+    with tempfile.TemporaryDirectory() as workdir:
+        cases(suite, workdir)
+
+    with open(args.output, "w") as f:
+        json.dump({"metadata": metadata(), "results": suite.results}, f, indent=2)
+    print(f"results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Compares cmb_utils.extract_thumbnails through reproject.thumbnails and through the
+batched extractor on a synthetic full-sky map: throughput in thumbnails per second
+and the difference between the two, relative to the standard deviation of the map.
+
+The difference is measured away from the border of the thumbnails: without
+apodization, reproject's Fourier oversampling treats each cutout as periodic and
+rings along its outermost pixels.
+
+Run from the repository root:
+
+    python benchmarks/thumbnails.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from cmb import cmb_utils, synthetic
+
+RESOLUTION = 0.125
+COUNTS = [100, 1000, 5000]
+BORDER = 2
+
+def random_coords(n, seed=0):
+    # (ra, dec) in degrees, uniform on the sphere away from the poles
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(-180, 180, n)
+    dec = np.rad2deg(np.arcsin(rng.uniform(-0.99, 0.99, n)))
+    return np.column_stack([ra, dec])
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+def main():
+    imap = synthetic.synthetic_map(RESOLUTION)
+    std = np.std(imap)
+    # the spline coefficients are computed once per map, outside of the timings
+    cmb_utils.extract_thumbnails(imap, random_coords(1), cache=None, method="batched")
+
+    print(f"{'thumbnails':>10} {'reproject [1/s]':>16} {'batched [1/s]':>14} {'max err':>9} {'rms err':>9}")
+    for n in COUNTS:
+        coords = random_coords(n)
+        reference, reference_time = timed(
+            lambda: cmb_utils.extract_thumbnails(imap, coords, cache=None))
+        batched, batched_time = timed(
+            lambda: cmb_utils.extract_thumbnails(imap, coords, cache=None, method="batched"))
+        inner = (slice(None), slice(BORDER, -BORDER), slice(BORDER, -BORDER))
+        error = np.abs(np.asarray(batched)[inner] - np.asarray(reference)[inner]) / std
+        print(f"{n:>10} {n / reference_time:>16.0f} {n / batched_time:>14.0f} "
+              f"{error.max():>9.2e} {np.sqrt(np.mean(error**2)):>9.2e}")
+
+if __name__ == "__main__":
+    main()
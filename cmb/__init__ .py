@@ -1 +0,0 @@
-# Empty file, required for Python to recognize this directory as a package.
@@ -0,0 +1,58 @@
+"""
+Code behind the CMB notebooks.
+
+Importing the package is cheap: submodules are imported on first access (`cmb.plot`,
+`from cmb import widgets`), and they import their heavy dependencies (pixell, astropy,
+scipy, matplotlib, ipywidgets, IPython) with `lazy_import` and `lazy_function`, which
+only load them on first use. The import cell of a notebook returns quickly, and the
+cost moves to the first plot or widget that needs them.
+"""
+import types
+import importlib
+
+submodules = [
+    "cmb_utils", "const", "cosmology", "functions", "i18n", "layout", "plot", "profiling",
+    "replay", "scheduler", "stacking", "synthetic", "tester", "widgets",
+]
+
+def __getattr__(name):
+    if name in submodules:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(list(globals()) + submodules)
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module, imported on first attribute access. The attributes of the
+    module are then copied onto the stand-in, so later accesses cost the same as on the
+    module itself.
+    """
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(vars(module))
+        return getattr(module, attr)
+
+def lazy_import(name):
+    """
+    Module `name`, imported when one of its attributes is first used. Replaces
+    `import name` or `from package import module`:
+
+        enmap = lazy_import("pixell.enmap")
+    """
+    return LazyModule(name)
+
+def lazy_function(module, name):
+    """
+    Function or class `name` of `module`, imported when first called. Replaces
+    `from module import name` for names that are only ever called:
+
+        display = lazy_function("IPython.display", "display")
+    """
+    def call(*args, **kwargs):
+        return getattr(importlib.import_module(module), name)(*args, **kwargs)
+
+    call.__name__ = call.__qualname__ = name
+    return call
@@ -1,58 +1,610 @@
-from pixell import colorize
-from pixell import enmap
-from scipy import ndimage
-from pixell import enmap
-import matplotlib.pyplot as plt
-import numpy as np
+import os
+import json
+import itertools
+import functools
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
 
-from pixell import reproject, colorize
+import numpy as np
 
 from .i18n import I18N
+from . import profiling, lazy_import
 i18n = I18N()
 
-# try registering a new colormap, pass if it exists
-try:
-    colorize.mpl_register("planck")
-except:
-    pass
+enmap = lazy_import("pixell.enmap")
+reproject = lazy_import("pixell.reproject")
+colorize = lazy_import("pixell.colorize")
+wcsutils = lazy_import("pixell.wcsutils")
+ndimage = lazy_import("scipy.ndimage")
+fft = lazy_import("scipy.fft")
+fits = lazy_import("astropy.io.fits")
+plt = lazy_import("matplotlib.pyplot")
+
+@functools.cache
+def register_colormap():
+    """ Registers pixell's "planck" colormap with matplotlib, before its first use """
+    # try registering a new colormap, pass if it exists
+    try:
+        colorize.mpl_register("planck")
+    except:
+        pass
+
+@profiling.profiled
+def load_cmb_map(filename, cache=True):
+    """
+    Loads the temperature (I) component of a CAR map stored in a FITS file.
+
+    Only the first component of an IQU cube is read, Q and U are never touched.
+    When the image is stored uncompressed and unscaled, the map is a memory-mapped
+    view of the file, so pixels are only paged in when they are used.
+
+    With cache enabled, the first load also writes a sidecar cache next to the file
+    (the raw component as `.npy` plus its WCS header as `.json`). Later loads map the
+    `.npy` directly and skip FITS parsing. The cache is rebuilt whenever the size or
+    modification time of the FITS file changes.
+
+    Parameters:
+    - filename: Path to the FITS file.
+    - cache: Whether to read from and write to the sidecar cache.
+
+    Returns:
+    - An enmap with the temperature component of the map.
+    """
+    if cache:
+        imap = read_map_cache(filename)
+        if imap is not None:
+            return imap
+
+    shape, wcs = enmap.read_map_geometry(filename)
+    # select the first component of every non-pixel axis (e.g. I from IQU)
+    sel = (0,) * (len(shape) - 2)
+
+    hdu = fits.open(filename, memmap=True)[0]
+    scaled = hdu.header.get("BSCALE", 1) != 1 or hdu.header.get("BZERO", 0) != 0
+    if isinstance(hdu, fits.PrimaryHDU) and not scaled:
+        imap = enmap.ndmap(hdu.data[sel], wcs)
+    else:
+        # compressed or scaled images can't be mapped, read only the component we need
+        imap = enmap.read_map(filename, sel=sel)
+
+    if cache:
+        write_map_cache(filename, imap)
+    return imap
+
+def map_cache_paths(filename):
+    return f"{filename}.npy", f"{filename}.json"
+
+def map_cache_key(filename):
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def read_map_cache(filename):
+    """
+    Reads the sidecar cache written by `write_map_cache`, returning None if it is
+    missing or stale.
+    """
+    npy_path, meta_path = map_cache_paths(filename)
+    try:
+        with open(meta_path, "r", encoding="utf-8") as file:
+            meta = json.load(file)
+        if meta["source"] != map_cache_key(filename):
+            return None
+        data = np.load(npy_path, mmap_mode="r")
+    except (OSError, ValueError, KeyError):
+        return None
 
-def load_cmb_map(filename):
-    imap = enmap.read_map(filename)
-    return imap[0]
+    wcs = wcsutils.WCS(fits.Header.fromstring(meta["wcs"]))
+    return enmap.ndmap(data, wcs)
 
-def view_map(imap, size=(40, 10)):
-    fig = plt.figure(figsize=size)
-    ax = fig.add_subplot(111, projection=imap.wcs)
-    ax.imshow(imap, origin="lower", cmap="planck")
+def write_map_cache(filename, imap):
+    """
+    Writes the map as a native byte order `.npy` plus a `.json` file holding its WCS
+    header and the size and modification time of the source file. Failing to write
+    (e.g. a read-only data directory) only means the next load parses the FITS again.
+    """
+    npy_path, meta_path = map_cache_paths(filename)
+    meta = {
+        "source": map_cache_key(filename),
+        "wcs": imap.wcs.to_header_string(),
+    }
+    data = np.ascontiguousarray(imap, dtype=imap.dtype.newbyteorder("="))
+    try:
+        # write to temporary files first so an interrupted write is never read back;
+        # the metadata goes last since it is what marks the cache as valid
+        with open(f"{npy_path}.tmp", "wb") as file:
+            np.save(file, data)
+        os.replace(f"{npy_path}.tmp", npy_path)
+        with open(f"{meta_path}.tmp", "w", encoding="utf-8") as file:
+            json.dump(meta, file)
+        os.replace(f"{meta_path}.tmp", meta_path)
+    except OSError:
+        pass
+
+# tokens identifying live maps, see map_token
+map_tokens = {}
+map_token_counter = itertools.count()
+
+def map_token(imap):
+    """
+    Returns an integer identifying `imap` for as long as it is alive. Unlike `id()`,
+    a token is never reused by a different map after the original is collected, so
+    it is safe to use as a cache key.
+    """
+    key = id(imap)
+    token = map_tokens.get(key)
+    if token is None:
+        token = next(map_token_counter)
+        map_tokens[key] = token
+        weakref.finalize(imap, map_tokens.pop, key, None)
+    return token
+
+# block-averaged levels of each map, keyed by map_token
+map_pyramids = {}
+
+@profiling.profiled
+def build_pyramid(imap, min_shape=(64, 128)):
+    """
+    Builds the block-averaged levels of a map, each one half the resolution of the
+    previous, stopping before a level would be smaller than `min_shape`. Every level
+    is an enmap with its own matching WCS.
+    """
+    levels = []
+    level = imap
+    while level.shape[-2] // 2 >= min_shape[0] and level.shape[-1] // 2 >= min_shape[1]:
+        level = enmap.downgrade(level, 2)
+        levels.append(level)
+    return levels
+
+def map_pyramid(imap):
+    """
+    Returns the levels of `imap` from the finest (the map itself) to the coarsest.
+    The coarser levels are built once per map and reused on later calls.
+    """
+    token = map_token(imap)
+    if token not in map_pyramids:
+        # the map itself is left out of the cache so it can still be collected
+        map_pyramids[token] = build_pyramid(imap)
+        weakref.finalize(imap, map_pyramids.pop, token, None)
+    return [imap] + map_pyramids[token]
+
+@profiling.profiled
+def display_level(imap, pixels, box=None):
+    """
+    Picks the coarsest pyramid level of `imap` that still fills `pixels` (height,
+    width) on screen. If `box` ([[dec_from, ra_from], [dec_to, ra_to]] in degrees)
+    is given, only that cutout of each level is considered and returned.
+    """
+    for level in reversed(map_pyramid(imap)):
+        if box is not None:
+            level = level.submap(np.deg2rad(box))
+        # imshow keeps the aspect ratio, so the image fills the figure along one axis
+        if level.shape[-2] >= pixels[0] or level.shape[-1] >= pixels[1]:
+            return level
+    return level
+
+@profiling.profiled
+def view_map(imap, size=(40, 10), box=None, dpi=None):
+    """
+    Displays a map using the coarsest resolution that still fills the figure.
+
+    Parameters:
+    - imap: Map to display.
+    - size: Figure size in inches.
+    - box: Optional region [[dec_from, ra_from], [dec_to, ra_to]] in degrees to zoom into.
+    - dpi: Figure resolution, defaults to matplotlib's figure.dpi.
+    """
+    if dpi is None:
+        dpi = plt.rcParams["figure.dpi"]
+    pixels = (size[1] * dpi, size[0] * dpi)
+    level = display_level(imap, pixels, box)
+
+    register_colormap()
+    fig = plt.figure(figsize=size, dpi=dpi)
+    ax = fig.add_subplot(111, projection=level.wcs)
+    ax.imshow(level, origin="lower", cmap="planck")
     ax.axis("off")
     plt.show()
 
-def find_maxima(imap, neighborhood_size=100, n_threshold=2):
-    # defines the radius in which we search for a local maximum
-    rms = np.std(imap)
-    threshold = 2 * n_threshold
-    imap_max = ndimage.maximum_filter(imap, neighborhood_size)
-    maxima = (imap == imap_max)
-    maxima[maxima < threshold] = 0
-    # data_min = filters.minimum_filter(data, neighborhood_size)
-    # diff = ((data_max - data_min) > threshold)
-    # maxima[diff == 0] = 0
-    labeled, num_objects = ndimage.label(maxima)
-    xy = np.array(ndimage.center_of_mass(imap, labeled, range(1, num_objects+1)))
-    coords = imap.pix2sky(xy.T).T
-    return coords
-
-def extract_thumbnails(imap, coords):
-    # assume coords are in degs
-    x, y = np.deg2rad(coords).T
-    # assume coords are in x, y format, but our subsequent 
-    # code assumes y, x, so we need to swap the order now
-    coords = np.array([y, x]).T
-    # now extract the thumbnails
-    thumbnails = reproject.thumbnails(imap, coords, r=np.deg2rad(1), apod=0)
+@profiling.profiled
+def find_maxima(imap, neighborhood_size=100, n_threshold=2, tile_size=1024, workers=None,
+                method="maximum", fwhm=1.0):
+    """
+    Finds the local maxima of a map that stand more than `n_threshold` standard
+    deviations above its mean.
+
+    With `method="matched"` the map is first convolved with a Gaussian beam of the
+    given `fwhm` (see `find_maxima_matched`) and `n_threshold` applies to the
+    signal-to-noise of the filtered map instead.
+
+    A pixel is a maximum when it is the largest value within a `neighborhood_size`
+    pixels wide box around it. The map is processed in tiles of `tile_size` pixels,
+    each padded with a halo of `neighborhood_size` pixels so the maximum filter sees
+    exactly the neighborhood it would see on the whole map. The result is therefore
+    identical for any tile size. Tiles run on a thread pool of `workers` threads, as
+    scipy.ndimage releases the GIL.
+
+    Parameters:
+    - imap: Map to search.
+    - neighborhood_size: Width of the box (in pixels) in which a maximum must be the largest value.
+    - n_threshold: Minimum height of a maximum, in standard deviations above the mean.
+    - tile_size: Width of the square tiles (in pixels) the map is split into.
+    - workers: Number of threads, defaults to the number of CPUs.
+    - method: Either "maximum" (maximum filter) or "matched" (FFT matched filter).
+    - fwhm: Beam width (in degrees) of the matched filter.
+
+    Returns:
+    - Catalog of shape (n, 3) with the ra, dec (in degrees, see `maxima_catalog`) and
+      amplitude of each maximum, ordered by pixel position.
+    """
+    if method == "matched":
+        return find_maxima_matched(imap, fwhm, n_threshold, workers)
+    if method != "maximum":
+        raise ValueError(f"unknown method {method!r}")
+
+    stats = map_statistics(imap)
+    threshold = stats.mean + n_threshold * stats.std
+    ny, nx = imap.shape[-2:]
+    halo = neighborhood_size
+
+    def find_tile(tile):
+        y0, x0 = tile
+        y1, x1 = min(y0 + tile_size, ny), min(x0 + tile_size, nx)
+        # pad the tile with the halo, clipped at the map edges where the filter
+        # applies its own boundary mode just like it does on the whole map
+        py0, px0 = max(y0 - halo, 0), max(x0 - halo, 0)
+        py1, px1 = min(y1 + halo, ny), min(x1 + halo, nx)
+        block = np.asarray(imap[py0:py1, px0:px1])
+        block_max = ndimage.maximum_filter(block, neighborhood_size)
+
+        inner = (slice(y0 - py0, y1 - py0), slice(x0 - px0, x1 - px0))
+        maxima = (block[inner] == block_max[inner]) & (block[inner] > threshold)
+        ys, xs = np.nonzero(maxima)
+        return ys + y0, xs + x0
+
+    tiles = [(y, x) for y in range(0, ny, tile_size) for x in range(0, nx, tile_size)]
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        found = list(pool.map(find_tile, tiles))
+
+    ys = np.concatenate([y for y, _ in found])
+    xs = np.concatenate([x for _, x in found])
+    order = np.argsort(ys * nx + xs)
+    return maxima_catalog(imap, ys[order], xs[order])
+
+def wrap_ra(imap, ra):
+    """
+    Wraps right ascensions (in radians) into the range covered by the columns of `imap`,
+    which starts at the outer edge of its first or last column.
+    """
+    # in CAR, ra is linear in the column index (pix2sky already wraps some columns of
+    # a full sky map, so it can't tell the edges)
+    wcs = imap.wcs.wcs
+    edges = wcs.crval[0] + (np.array([-0.5, imap.shape[-1] - 0.5]) + 1 - wcs.crpix[0]) * wcs.cdelt[0]
+    start = np.deg2rad(edges.min())
+    return start + (ra - start) % (2 * np.pi)
+
+def maxima_catalog(imap, ys, xs):
+    """
+    Catalog of the pixels (`ys`, `xs`) of `imap`, with the columns ra, dec (in degrees,
+    ra in the range of the map, see `wrap_ra`) and value. The first two columns are in
+    the order `extract_thumbnails` takes, so `catalog[:, :2]` can be passed to it.
+    """
+    if len(ys) == 0:
+        # pix2sky can't reshape an empty set of pixels
+        return np.empty((0, 3))
+    dec, ra = imap.pix2sky([ys, xs])
+    return np.column_stack([np.rad2deg(wrap_ra(imap, ra)), np.rad2deg(dec), imap[ys, xs]])
+
+@functools.lru_cache(maxsize=8)
+def matched_filter_kernel(shape, header, fwhm, bin_width=10):
+    """
+    Fourier space Gaussian beam for the real FFT of a map with the given geometry,
+    along with the multipole bin of each Fourier pixel used to estimate the map power.
+    Cached per geometry (`header` is the WCS as a string, so it can be hashed).
+    """
+    wcs = wcsutils.WCS(fits.Header.fromstring(header))
+    # the real FFT only keeps the non-negative frequencies of the last axis
+    ell = enmap.modlmap(shape, wcs)[:, :shape[-1] // 2 + 1]
+    sigma = np.deg2rad(fwhm) / np.sqrt(8 * np.log(2))
+    beam = np.exp(-0.5 * (ell * sigma)**2)
+    bins = (ell / bin_width).astype(int)
+    return beam, bins
+
+@profiling.profiled
+def find_maxima_matched(imap, fwhm=1.0, n_threshold=2, workers=None):
+    """
+    Finds sources by matched filtering the map with a Gaussian beam of `fwhm` degrees
+    in Fourier space and keeping the peaks of the filtered map whose signal-to-noise
+    is above `n_threshold`. Everything that isn't a source (the CMB itself included)
+    is treated as noise, with a power spectrum estimated from the map. A peak is the
+    largest value within a box one beam width (`fwhm`) across. The cost is
+    O(N log N) whatever the size of the sources.
+
+    Returns:
+    - Catalog of shape (n, 3) with the ra, dec (in degrees, see `maxima_catalog`) and
+      amplitude of each source in the unfiltered map, ordered by pixel position.
+    """
+    shape = imap.shape[-2:]
+    beam, bins = matched_filter_kernel(shape, imap.wcs.to_header_string(), fwhm)
+    workers = workers or os.cpu_count()
+
+    kmap = fft.rfft2(np.asarray(imap, dtype=float), workers=workers)
+    # azimuthally averaged power of the map, which weights down the scales where
+    # the background fluctuates the most
+    power = np.bincount(bins.ravel(), np.abs(kmap.ravel())**2) / np.maximum(np.bincount(bins.ravel()), 1)
+    power = power[bins]
+    kernel = np.divide(beam, power, out=np.zeros_like(beam), where=power > 0)
+
+    filtered = fft.irfft2(kmap * kernel, s=shape, workers=workers)
+    snr = (filtered - filtered.mean()) / filtered.std()
+
+    # dividing by the power boosts the small scales, so the filtered map isn't
+    # guaranteed to be smooth on the beam scale; a peak must be the largest value
+    # within one beam width, which also keeps a single detection per source
+    pixel = np.min(np.abs(imap.wcs.wcs.cdelt))
+    size = max(3, 2 * int(round(fwhm / pixel / 2)) + 1)
+    maxima = (snr == ndimage.maximum_filter(snr, size)) & (snr > n_threshold)
+    ys, xs = np.nonzero(maxima)
+    return maxima_catalog(imap, ys, xs)
+
+class ThumbnailCache:
+    """
+    Least recently used cache of extracted thumbnails, bounded by the total size
+    of the thumbnails it holds.
+    """
+
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # widgets extract thumbnails from background threads
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            thumbnail = self.entries.get(key)
+            if thumbnail is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return thumbnail
+
+    def put(self, key, thumbnail):
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key).nbytes
+            self.entries[key] = thumbnail
+            self.nbytes += thumbnail.nbytes
+            # always keep the newest entry, even if it alone exceeds the limit
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "nbytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+        }
+
+# shared cache used by extract_thumbnails
+thumbnail_cache = ThumbnailCache()
+
+@profiling.profiled
+def extract_thumbnails(imap, coords, r=np.deg2rad(1), apod=0, cache=thumbnail_cache, processes=None,
+                       method="reproject"):
+    """
+    Extracts a thumbnail of radius `r` (in radians) around each (ra, dec) coordinate
+    (in degrees). A catalog from `find_maxima` is passed as `catalog[:, :2]`.
+
+    Thumbnails already extracted from the same map are served from `cache`, so only
+    new coordinates reach `reproject.thumbnails`. Pass `cache=None` to always extract.
+    With `processes` greater than one, the new coordinates are split across a process
+    pool (see `extract_thumbnails_parallel`), which pays off for large catalogs.
+    With `method="batched"`, they are all sampled at once by `extract_thumbnails_batched`
+    instead, which is much faster but only supports 2-D maps and no apodization.
+    """
+    if method not in ("reproject", "batched"):
+        raise ValueError(f"unknown method {method!r}")
+    if method == "batched" and apod:
+        raise ValueError("the batched extraction doesn't apodize")
+
+    coords = np.asarray(coords, dtype=float)
+    if coords.shape[-1] != 2:
+        raise ValueError(f"coords must be (ra, dec) pairs, got an array of shape {coords.shape}")
+    # round the coordinates so that the same position always maps to the same entry
+    coords = np.round(coords.reshape(-1, 2), 6)
+    if len(coords) == 0:
+        # e.g. the catalog of a search that found no maxima
+        oshape, owcs, _ = thumbnail_grid(r, np.deg2rad(np.min(np.abs(imap.wcs.wcs.cdelt))) / 2)
+        return enmap.zeros((0,) + imap.shape[:-2] + oshape, owcs, imap.dtype)
+    token = map_token(imap)
+    keys = [(token, x, y, r, apod, method) for x, y in coords]
+
+    thumbnails = [None] * len(keys)
+    if cache is not None:
+        thumbnails = [cache.get(key) for key in keys]
+    missing = [i for i, thumbnail in enumerate(thumbnails) if thumbnail is None]
+
+    if missing:
+        # assume coords are in degs
+        x, y = np.deg2rad(coords[missing]).T
+        # assume coords are in x, y format, but our subsequent 
+        # code assumes y, x, so we need to swap the order now
+        pos = np.array([y, x]).T
+        # now extract the thumbnails
+        if method == "batched":
+            extracted = extract_thumbnails_batched(imap, pos, r=r)
+        elif processes is not None and processes > 1:
+            extracted = extract_thumbnails_parallel(imap, pos, r, apod, processes)
+        else:
+            extracted = reproject.thumbnails(imap, pos, r=r, apod=apod)
+        for i, thumbnail in zip(missing, extracted):
+            # copy so each entry owns its memory instead of a view into the batch
+            thumbnail = thumbnail.copy()
+            thumbnails[i] = thumbnail
+            if cache is not None:
+                cache.put(keys[i], thumbnail)
+
+    return enmap.enmap(np.array(thumbnails), thumbnails[0].wcs)
+
+@functools.lru_cache(maxsize=8)
+def thumbnail_grid(r, res):
+    """
+    Geometry of a thumbnail of radius `r` and resolution `res` (in radians), the same
+    as `reproject.thumbnails` uses, along with the unit vector of each of its pixels
+    when the thumbnail is centred on dec = ra = 0. Cached per radius and resolution.
+
+    Returns:
+    - Tuple with the shape, the WCS and the (3, ny, nx) unit vectors.
+    """
+    oshape, owcs = enmap.thumbnail_geometry(r=r, res=res, proj="car")
+    dec, ra = enmap.posmap(oshape, owcs)
+    vectors = np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+    return tuple(oshape), owcs, vectors
+
+# spline coefficients of each map, keyed by map_token and spline order
+map_splines = {}
+
+def map_spline(imap, order, mode):
+    """
+    Returns the spline coefficients of `imap` for `ndimage.map_coordinates`, computed
+    once per map and order. Orders 0 (nearest) and 1 (linear) interpolate the pixels
+    themselves, without prefiltering.
+    """
+    if order not in range(6):
+        raise ValueError(f"spline order must be between 0 and 5, got {order!r}")
+    if order < 2:
+        return np.asarray(imap, dtype=float)
+    key = (map_token(imap), order, mode)
+    if key not in map_splines:
+        map_splines[key] = ndimage.spline_filter(np.asarray(imap, dtype=float), order, mode=mode)
+        weakref.finalize(imap, map_splines.pop, key, None)
+    return map_splines[key]
+
+@profiling.profiled
+def extract_thumbnails_batched(imap, pos, r=np.deg2rad(1), order=3):
+    """
+    Batched version of `reproject.thumbnails(imap, pos, r=r, apod=0)` for a 2-D map,
+    with the positions (dec, ra) in radians.
+
+    The pixel grid of a thumbnail is built once per radius and resolution, rotated to
+    every position in a single vectorized step, and the map is sampled at all the
+    thumbnails' pixels in one `ndimage.map_coordinates` call, from spline coefficients
+    cached per map. The geometry matches `reproject.thumbnails` exactly; the values
+    differ slightly as the map is interpolated with a plain spline of the given
+    `order` instead of being Fourier oversampled first.
+
+    Returns:
+    - Enmap of shape (n, ny, nx) with the geometry of the thumbnails.
+    """
+    if imap.ndim != 2:
+        raise ValueError("the batched extraction needs a 2-D map")
+    res = np.deg2rad(np.min(np.abs(imap.wcs.wcs.cdelt))) / 2
+    oshape, owcs, vectors = thumbnail_grid(r, res)
+
+    # rotation taking dec = ra = 0 to each position: about y by dec, then about z by ra
+    pos = np.asarray(pos, dtype=float)
+    if pos.shape[-1] != 2:
+        raise ValueError(f"pos must be (dec, ra) pairs, got an array of shape {pos.shape}")
+    dec, ra = pos.reshape(-1, 2).T
+    cos_dec, sin_dec, cos_ra, sin_ra = np.cos(dec), np.sin(dec), np.cos(ra), np.sin(ra)
+    zero = np.zeros_like(dec)
+    rotation = np.stack([
+        np.stack([cos_ra * cos_dec, -sin_ra, -cos_ra * sin_dec], axis=-1),
+        np.stack([sin_ra * cos_dec, cos_ra, -sin_ra * sin_dec], axis=-1),
+        np.stack([sin_dec, zero, cos_dec], axis=-1),
+    ], axis=-2)
+    x, y, z = np.einsum("nij,j...->in...", rotation, vectors)
+    sky = np.stack([np.arcsin(np.clip(z, -1, 1)), wrap_ra(imap, np.arctan2(y, x))])
+    pix = imap.sky2pix(sky, safe=False)
+
+    # wrap around in ra when the map covers the whole circle
+    fullsky = np.isclose(imap.shape[-1] * abs(imap.wcs.wcs.cdelt[0]), 360)
+    mode = "grid-wrap" if fullsky else "nearest"
+    values = ndimage.map_coordinates(map_spline(imap, order, mode), pix, order=order,
+                                     mode=mode, prefilter=False)
+    return enmap.ndmap(values.astype(imap.dtype, copy=False), owcs.deepcopy())
+
+# map and output array of an extraction worker process, see extract_thumbnails_parallel
+worker_arrays = None
+
+def attach_worker_arrays(map_name, map_shape, header, out_name, out_shape, dtype):
+    """ Initializer of the extraction processes, attaches to the shared map and output """
+    global worker_arrays
+    map_memory = shared_memory.SharedMemory(name=map_name)
+    out_memory = shared_memory.SharedMemory(name=out_name)
+    wcs = wcsutils.WCS(fits.Header.fromstring(header))
+    imap = enmap.ndmap(np.ndarray(map_shape, dtype, buffer=map_memory.buf), wcs)
+    out = np.ndarray(out_shape, dtype, buffer=out_memory.buf)
+    # the memory objects are kept so the buffers stay mapped
+    worker_arrays = (map_memory, out_memory, imap, out)
+
+def extract_chunk(start, pos, r, apod):
+    """ Extracts the thumbnails of a chunk of positions into the shared output, from `start` on """
+    _, _, imap, out = worker_arrays
+    out[start:start + len(pos)] = reproject.thumbnails(imap, pos, r=r, apod=apod)
+
+@profiling.profiled
+def extract_thumbnails_parallel(imap, pos, r=np.deg2rad(1), apod=0, processes=None, chunks_per_process=4):
+    """
+    Same as `reproject.thumbnails(imap, pos, r=r, apod=apod)`, with the positions (dec, ra
+    in radians) split in chunks across a pool of `processes` processes (the number of
+    CPUs by default).
+
+    The map is copied once into shared memory, which every process maps read-only
+    instead of receiving a pickled copy per task. The processes write their thumbnails
+    straight into a shared output array, at the index of their positions, so the
+    result is in input order and identical to the serial extraction.
+    """
+    processes = processes or os.cpu_count()
+    # the first thumbnail gives the shape, dtype and geometry of all of them
+    first = reproject.thumbnails(imap, pos[:1], r=r, apod=apod)
+    out_shape = (len(pos),) + first.shape[1:]
+
+    map_memory = shared_memory.SharedMemory(create=True, size=max(imap.nbytes, 1))
+    out_memory = shared_memory.SharedMemory(create=True, size=max(first[0].nbytes * len(pos), 1))
+    try:
+        np.ndarray(imap.shape, imap.dtype, buffer=map_memory.buf)[...] = imap
+        out = np.ndarray(out_shape, first.dtype, buffer=out_memory.buf)
+        out[0] = first[0]
+
+        step = max(1, -(-(len(pos) - 1) // (processes * chunks_per_process)))
+        initargs = (map_memory.name, imap.shape, imap.wcs.to_header_string(),
+                    out_memory.name, out_shape, imap.dtype)
+        with ProcessPoolExecutor(processes, initializer=attach_worker_arrays, initargs=initargs) as pool:
+            tasks = [pool.submit(extract_chunk, start, pos[start:start + step], r, apod)
+                     for start in range(1, len(pos), step)]
+            for task in tasks:
+                task.result()
+
+        thumbnails = enmap.ndmap(out.copy(), first.wcs)
+    finally:
+        # the shared buffers can't be closed while an array still points into them
+        out = None
+        map_memory.close()
+        map_memory.unlink()
+        out_memory.close()
+        out_memory.unlink()
     return thumbnails
 
+@profiling.profiled
 def plot_thumbnails(thumbnails, ncol=5, figsize=(10,10)):
+    register_colormap()
     fig = plt.figure(figsize=figsize)
     nrow = int(np.ceil(len(thumbnails) / ncol))
     for i, thumb in enumerate(thumbnails):
@@ -63,14 +615,221 @@ def plot_thumbnails(thumbnails, ncol=5, figsize=(10,10)):
     plt.tight_layout()
     plt.show()
 
+@functools.lru_cache(maxsize=8)
+def radial_bins(shape, header, rmax=1, nbins=19):
+    """
+    Radial bin of each pixel of a thumbnail with the given geometry (`header` is the
+    WCS as a string, so it can be hashed), for `nbins` equal bins between the centre
+    and `rmax` degrees. Pixels beyond `rmax` get the extra bin `nbins`. Cached per
+    geometry, as every thumbnail of a stack shares it.
+
+    Returns:
+    - Tuple with the flat bin index of each pixel, the number of pixels in each bin
+      and the bin centers (in degrees).
+    """
+    wcs = wcsutils.WCS(fits.Header.fromstring(header))
+    r = np.rad2deg(enmap.modrmap(shape, wcs))
+    bins = np.linspace(0, rmax, nbins + 1)
+    index = np.digitize(r, bins).ravel() - 1
+    counts = np.bincount(index, minlength=nbins + 1)[:nbins]
+    return index, counts, (bins[1:] + bins[:-1]) / 2
+
+@profiling.profiled
+def radial_profiles(thumbnails, rmax=1, nbins=19):
+    """
+    Mean of each thumbnail in `nbins` radial bins out to `rmax` degrees, all the
+    thumbnails of the stack at once with a single `np.bincount`.
+
+    Parameters:
+    - thumbnails: Enmap of shape (n, ny, nx), or a single (ny, nx) thumbnail.
+
+    Returns:
+    - Tuple with the bin centers (in degrees) and the profiles, of shape (n, nbins)
+      or (nbins,) for a single thumbnail. Empty bins are NaN.
+    """
+    shape = thumbnails.shape[-2:]
+    index, counts, centers = radial_bins(shape, thumbnails.wcs.to_header_string(), rmax, nbins)
+    values = np.asarray(thumbnails, dtype=float).reshape(-1, shape[0] * shape[1])
+
+    # shift the bins of each thumbnail so they all fall in a single bincount
+    stride = nbins + 1
+    shifted = (index + stride * np.arange(len(values))[:, None]).ravel()
+    sums = np.bincount(shifted, values.ravel(), minlength=stride * len(values))
+    sums = sums.reshape(len(values), stride)[:, :nbins]
+    profiles = np.divide(sums, counts, out=np.full_like(sums, np.nan), where=counts > 0)
+    return centers, profiles.reshape(thumbnails.shape[:-2] + (nbins,))
+
+@profiling.profiled
+def stacked_radial_profile(thumbnails, rmax=1, nbins=19):
+    """
+    Radial profile of a stack of thumbnails, see `radial_profiles`.
+
+    Returns:
+    - Tuple with the bin centers (in degrees), the mean profile of the stack and its
+      standard error.
+    """
+    centers, profiles = radial_profiles(thumbnails, rmax, nbins)
+    n = len(profiles)
+    error = np.std(profiles, axis=0, ddof=1) / np.sqrt(n) if n > 1 else np.zeros(nbins)
+    return centers, profiles.mean(axis=0), error
+
+def gaussian_model(params, x, y, jacobian=False):
+    """
+    Elliptical 2-D Gaussian plus offset for a batch of parameter sets (amplitude, x0,
+    y0, a, b, c, offset) of shape (n, 7), on the pixel coordinates `x` and `y`. The
+    Gaussian is amplitude * exp(-q / 2) with q = a dx^2 + 2 b dx dy + c dy^2.
+
+    Returns:
+    - The model, of shape (n, npix), and with `jacobian=True` also its Jacobian with
+      respect to the parameters, of shape (n, 7, npix).
+    """
+    amplitude, x0, y0, a, b, c, offset = (p[:, None] for p in params.T)
+    dx, dy = x - x0, y - y0
+    g = np.exp(-0.5 * (a * dx**2 + 2 * b * dx * dy + c * dy**2))
+    ag = amplitude * g
+    model = ag + offset
+    if not jacobian:
+        return model
+
+    # filled row by row, each parameter's derivatives contiguous for the matrix products
+    result = np.empty((len(params), 7, len(x)))
+    result[:, 0] = g
+    np.multiply(ag, a * dx + b * dy, out=result[:, 1])
+    np.multiply(ag, b * dx + c * dy, out=result[:, 2])
+    np.multiply(-0.5 * ag, dx**2, out=result[:, 3])
+    np.multiply(-ag, dx * dy, out=result[:, 4])
+    np.multiply(-0.5 * ag, dy**2, out=result[:, 5])
+    result[:, 6] = 1
+    return model, result
+
+def gaussian_initial_guess(values, x, y):
+    """
+    Moment based starting point of the Gaussian fits: the offset is the median of
+    each thumbnail, and the pixels above half of the peak give the centroid and,
+    through the area of the half maximum contour, a round width.
+    """
+    offset = np.median(values, axis=1)
+    amplitude = values.max(axis=1) - offset
+    core = values >= (offset + amplitude / 2)[:, None]
+    count = core.sum(axis=1)
+    x0 = (core * x).sum(axis=1) / count
+    y0 = (core * y).sum(axis=1) / count
+    # the half maximum contour of a round Gaussian encloses 2 ln(2) pi sigma^2
+    inverse_variance = 2 * np.log(2) * np.pi / count
+    zero = np.zeros_like(offset)
+    return np.column_stack([amplitude, x0, y0, inverse_variance, zero, inverse_variance, offset])
+
+@profiling.profiled
+def fit_gaussians(thumbnails, iterations=30, chunk_size=256):
+    """
+    Fits an elliptical 2-D Gaussian plus offset to every thumbnail of a stack at once.
+
+    Every fit starts from `gaussian_initial_guess` and takes `iterations` steps of
+    Levenberg-Marquardt with the analytic Jacobian, all thumbnails of a chunk of
+    `chunk_size` advancing together: the normal equations of the chunk are built
+    with batched matrix products and solved with a single batched `np.linalg.solve`. A step
+    is kept only where it lowers the residual and leaves the Gaussian well defined,
+    otherwise the damping of that thumbnail increases.
+
+    Parameters:
+    - thumbnails: Enmap of shape (n, ny, nx), or a single (ny, nx) thumbnail.
+    - iterations: Number of Levenberg-Marquardt steps.
+    - chunk_size: Number of thumbnails fitted together, which bounds the memory used
+      by the Jacobians.
+
+    Returns:
+    - Dictionary of arrays of length n: "amplitude" and "offset" (in map units), "x"
+      and "y" (centre offsets from the middle of the thumbnail, in degrees),
+      "fwhm_major", "fwhm_minor" and "fwhm" (their geometric mean) in degrees,
+      "angle" (of the major axis from the x axis, in degrees) and "rms" (of the
+      residual, in map units).
+    """
+    ny, nx = thumbnails.shape[-2:]
+    values = np.asarray(thumbnails, dtype=float).reshape(-1, ny * nx)
+    y, x = np.indices((ny, nx)).reshape(2, -1) - np.array([[(ny - 1) / 2], [(nx - 1) / 2]])
+
+    params = np.concatenate([
+        fit_gaussian_chunk(values[start:start + chunk_size], x, y, iterations)
+        for start in range(0, len(values), chunk_size)
+    ])
+    amplitude, x0, y0, a, b, c, offset = params.T
+    rms = np.sqrt(np.mean((values - gaussian_model(params, x, y))**2, axis=1))
+
+    # the axes of the ellipse are the eigenvalues of the covariance, the inverse of
+    # the [[a, b], [b, c]] matrix
+    trace, determinant = a + c, a * c - b**2
+    root = np.sqrt(np.maximum((a - c)**2 / 4 + b**2, 0))
+    inverse_major, inverse_minor = trace / 2 - root, trace / 2 + root
+    pixel = np.min(np.abs(thumbnails.wcs.wcs.cdelt))
+    to_fwhm = np.sqrt(8 * np.log(2)) * pixel
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fwhm_major = to_fwhm / np.sqrt(inverse_major)
+        fwhm_minor = to_fwhm / np.sqrt(inverse_minor)
+    fwhm_major[determinant <= 0] = np.nan
+    fwhm_minor[determinant <= 0] = np.nan
+
+    return {
+        "amplitude": amplitude,
+        "offset": offset,
+        "x": x0 * pixel,
+        "y": y0 * pixel,
+        "fwhm_major": fwhm_major,
+        "fwhm_minor": fwhm_minor,
+        "fwhm": np.sqrt(fwhm_major * fwhm_minor),
+        "angle": np.rad2deg(0.5 * np.arctan2(-2 * b, c - a)),
+        "rms": rms,
+    }
+
+def fit_gaussian_chunk(values, x, y, iterations, tolerance=1e-10):
+    """ Levenberg-Marquardt fits of a chunk of flattened thumbnails, see `fit_gaussians` """
+    params = gaussian_initial_guess(values, x, y)
+    model, jacobian = gaussian_model(params, x, y, jacobian=True)
+    cost = np.sum((values - model)**2, axis=1)
+    damping = np.full(len(values), 1e-3)
+    done = np.zeros(len(values), dtype=bool)
+
+    for _ in range(iterations):
+        residual = values - model
+        normal = jacobian @ jacobian.transpose(0, 2, 1)
+        gradient = (jacobian @ residual[:, :, None])[:, :, 0]
+        diagonal = np.einsum("nii->ni", normal)
+        damped = normal + (damping[:, None] * diagonal)[:, :, None] * np.eye(7)
+        try:
+            step = np.linalg.solve(damped, gradient[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            # a singular system in the batch, solve the thumbnails one by one
+            step = np.array([np.linalg.lstsq(m, g, rcond=None)[0] for m, g in zip(damped, gradient)])
+
+        trial = params + step
+        # a wild step can overflow, its cost is then not finite and the step rejected
+        with np.errstate(over="ignore", invalid="ignore"):
+            trial_model = gaussian_model(trial, x, y)
+            trial_cost = np.sum((values - trial_model)**2, axis=1)
+        _, x0, y0, a, b, c, _ = trial.T
+        # keep the centre within the thumbnail, and the Gaussian well defined
+        inside = (np.abs(x0) <= x.max()) & (np.abs(y0) <= y.max())
+        better = (trial_cost < cost) & inside & (a > 0) & (c > 0) & (a * c > b**2)
+
+        # a fit is done once its steps stop improving it, or keep failing
+        done |= better & (cost - trial_cost <= tolerance * cost)
+        done |= damping > 1e8
+        if done.all():
+            break
+
+        params[better] = trial[better]
+        model[better] = trial_model[better]
+        cost[better] = trial_cost[better]
+        damping = np.where(better, damping / 10, damping * 10)
+        if better.any():
+            _, jacobian[better] = gaussian_model(params[better], x, y, jacobian=True)
+    return params
+
+@profiling.profiled
 def extract_profile(mean_img):
-    r = np.rad2deg(mean_img.modrmap())
-    bins = np.linspace(0, 1, 20)
-    idx = np.digitize(r, bins)
-    mean_profile = np.array([np.mean(mean_img[idx == k]) for k in range(1, len(bins))])
-    bin_centers = (bins[1:] + bins[:-1])/2
+    bin_centers, mean_profile = radial_profiles(mean_img)
     return bin_centers, mean_profile * 1e6  # uK
 
+@profiling.profiled
 def measure_profile(x, profile):
     from ipywidgets import interact
 
@@ -82,25 +841,166 @@ def measure_profile(x, profile):
         plt.xlabel(i18n.gettext("xlabel_degrees"))
     return fun
 
-def H_a(a, H_0, Omega_m, Omega_lambda, Omega_r):
-    return H_0 * (Omega_m * a**-3 + Omega_lambda + Omega_r * a**-4)**0.5
+def row_blocks(imap, block_bytes=32 * 2**20):
+    """
+    Splits the pixels of `imap` into blocks of whole rows, each about `block_bytes`
+    once converted to float64. The blocks are views, so nothing of a memory mapped
+    map is read until a block is used.
+    """
+    rows = np.asarray(imap).reshape(-1, imap.shape[-1])
+    step = max(1, block_bytes // (8 * rows.shape[1]))
+    for start in range(0, len(rows), step):
+        yield rows[start:start + step]
+
+def map_blocks(fn, imap, workers=None, block_bytes=32 * 2**20):
+    """
+    Yields `fn(block)` for each row block of `imap`, in order. The blocks are handled
+    on a thread pool of `workers` threads (the number of CPUs by default), so at most
+    about `workers` blocks are in memory at once.
+    """
+    workers = workers or os.cpu_count()
+    blocks = row_blocks(imap, block_bytes)
+    if workers == 1:
+        yield from map(fn, blocks)
+        return
+    with ThreadPoolExecutor(workers) as pool:
+        pending = []
+        for block in blocks:
+            pending.append(pool.submit(fn, block))
+            # don't read ahead of the blocks being reduced
+            if len(pending) >= 2 * workers:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+def block_moments(block):
+    """
+    Returns the (count, mean, sum of squared deviations, min, max) of a block.
+    """
+    block = np.asarray(block, dtype=float)
+    mean = block.mean()
+    return block.size, mean, np.sum((block - mean)**2), block.min(), block.max()
+
+def merge_moments(a, b):
+    """
+    Combines the moments of two blocks (see `block_moments`) with Chan et al.'s
+    pairwise update, which stays accurate for any number of blocks.
+    """
+    n_a, mean_a, m2_a, min_a, max_a = a
+    n_b, mean_b, m2_b, min_b, max_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    m2 = m2_a + m2_b + delta**2 * n_a * n_b / n
+    return n, mean, m2, min(min_a, min_b), max(max_a, max_b)
+
+class MapStatistics:
+    """
+    Summary statistics of the pixels of a map: mean, std, min, max and a fine base
+    histogram spanning [min, max]. Histograms with fewer bins are re-binned from the
+    base one instead of going over the pixels again.
+    """
 
+    def __init__(self, mean, std, min, max, counts, edges):
+        self.mean = mean
+        self.std = std
+        self.min = min
+        self.max = max
+        self.counts = counts
+        self.edges = edges
+
+    @classmethod
+    def from_map(cls, imap, base_bins=10000, workers=None, block_bytes=32 * 2**20):
+        """
+        Computes the statistics of `imap` out of core, in blocks of rows of about
+        `block_bytes` (see `map_blocks`), so a memory mapped map larger than the
+        memory is never loaded whole. It takes two passes over the map: the first
+        for the moments and the range, the second for the histogram. Doesn't touch
+        matplotlib, so it can run on a background thread.
+
+        Parameters:
+        - imap: Map, possibly memory mapped.
+        - base_bins: Number of bins of the base histogram.
+        - workers: Number of threads, defaults to the number of CPUs.
+        - block_bytes: Approximate size of a block once converted to float64.
+        """
+        n, mean, m2, lo, hi = functools.reduce(
+            merge_moments, map_blocks(block_moments, imap, workers, block_bytes)
+        )
+
+        def block_histogram(block):
+            return np.histogram(block, bins=base_bins, range=(lo, hi))[0]
+
+        counts = functools.reduce(np.add, map_blocks(block_histogram, imap, workers, block_bytes))
+        edges = np.histogram_bin_edges([lo, hi], bins=base_bins, range=(lo, hi))
+        return cls(mean, np.sqrt(m2 / n), lo, hi, counts, edges)
+
+    def histogram(self, bins=100):
+        """
+        Histogram with `bins` equal bins over [min, max], like `np.histogram(imap, bins)`.
+
+        The counts are exact when `bins` divides the number of base bins. Otherwise the
+        base bins straddling a new edge are split proportionally, which misplaces at
+        most the pixels of one base bin per edge.
+
+        Returns:
+        - Tuple with the counts and the edges.
+        """
+        base_bins = len(self.counts)
+        edges = np.linspace(self.min, self.max, bins + 1)
+        if base_bins % bins == 0:
+            return self.counts.reshape(bins, -1).sum(axis=1), edges
+
+        cumulative = np.concatenate([[0], np.cumsum(self.counts)])
+        at_edges = np.rint(np.interp(edges, self.edges, cumulative)).astype(cumulative.dtype)
+        return np.diff(at_edges), edges
+
+    def clipped_std(self, n_sigma=3, iterations=10):
+        """
+        Sigma-clipped rms: the std of the pixels within `n_sigma` standard deviations
+        of the mean, clipping again with the new mean and std until the selection
+        stops changing or after `iterations` rounds. Evaluated on the base histogram,
+        each pixel taken at the center of its bin, so it needs no pass over the map.
+        """
+        centers = (self.edges[:-1] + self.edges[1:]) / 2
+        mean, std = self.mean, self.std
+        keep = None
+        for _ in range(iterations):
+            new_keep = np.abs(centers - mean) <= n_sigma * std
+            if keep is not None and np.array_equal(keep, new_keep):
+                break
+            keep = new_keep
+            weights = self.counts * keep
+            mean = np.average(centers, weights=weights)
+            std = np.sqrt(np.average((centers - mean)**2, weights=weights))
+        return std
+
+# statistics of each map, keyed by map_token
+map_statistics_cache = {}
+
+@profiling.profiled
+def map_statistics(imap):
+    """
+    Returns the MapStatistics of `imap`, computed once per map and reused until the
+    map is replaced.
+    """
+    token = map_token(imap)
+    if token not in map_statistics_cache:
+        map_statistics_cache[token] = MapStatistics.from_map(imap)
+        weakref.finalize(imap, map_statistics_cache.pop, token, None)
+    return map_statistics_cache[token]
+
+@profiling.profiled
 def measure_distance(h_0=70):
-    from scipy import integrate
     from ipywidgets import interact 
-    from astropy.cosmology import Planck18 as cosmo
+    from . import cosmology
 
     @interact(H_0=h_0)
     def fun(H_0):
-        a_recomb = 1 / (1 + 1100)
-
-        integrand = lambda a: 1 / (a**2 * H_a(a, H_0, cosmo.Om0, cosmo.Ode0, cosmo.Ogamma0) / 3e5)
-        comoving_dist = integrate.quad(integrand, a_recomb, 1)[0]
+        # both quantities scale as 1 / H_0, the integrals are computed only once
+        comoving_dist = cosmology.comoving_distance(H_0)
         print(i18n.gettext("distance_to_recombination").format(comoving_dist))
 
-        integrand = lambda a: 1 / (a * H_a(a, H_0, cosmo.Om0, cosmo.Ode0, cosmo.Ogamma0) / 3e5)
-        physical_dist = integrate.quad(integrand, a_recomb, 1)[0]
-        c = 3.06e-7  # Mpc/yr
-        print(i18n.gettext("travel_time_to_recombination").format(physical_dist / c / 1e9))
+        print(i18n.gettext("travel_time_to_recombination").format(cosmology.travel_time(H_0)))
 
     return fun
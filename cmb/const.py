@@ -12,11 +12,15 @@ moon_angular_size = 0.00908 # Angular size of the Moon, rad
 
 wavelengths = np.linspace(100e-9, 2000e-9, 100) # 100 points from 100 nm to 2000 nm
 
-reference_objects = [
-    (i18n.gettext("object_sun"), 5778),
-    (i18n.gettext("object_sirius_a"), 9940),
-    (i18n.gettext("object_red_dwarf"), 3200)
-]
+def __getattr__(name):
+    # reference_objects is built on access, so the names follow the locale set after import
+    if name == "reference_objects":
+        return [
+            (i18n.gettext("object_sun"), 5778),
+            (i18n.gettext("object_sirius_a"), 9940),
+            (i18n.gettext("object_red_dwarf"), 3200)
+        ]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # COBE/FIRAS CMB monopole spectrum
 # frequency[cm^-1] by intensity [MJy/sr]
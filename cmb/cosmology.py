@@ -0,0 +1,81 @@
+import functools
+
+import numpy as np
+
+c_km_s = 3e5       # Speed of light, km/s
+c_mpc_yr = 3.06e-7 # Speed of light, Mpc/yr
+
+z_recombination = 1100
+
+@functools.lru_cache(maxsize=None)
+def planck18_densities():
+    """
+    Returns the (Omega_m, Omega_lambda, Omega_r) density parameters of Planck 2018.
+    """
+    from astropy.cosmology import Planck18 as cosmo
+    return cosmo.Om0, cosmo.Ode0, cosmo.Ogamma0
+
+def E(a, Omega_m, Omega_lambda, Omega_r):
+    """ Dimensionless Hubble parameter H(a) / H_0 """
+    return (Omega_m * a**-3 + Omega_lambda + Omega_r * a**-4)**0.5
+
+@functools.lru_cache(maxsize=32)
+def dimensionless_integrals(Omega_m, Omega_lambda, Omega_r, z, panels=64, order=8):
+    """
+    Integrates the parts of the comoving distance and the light travel time that
+    don't depend on H_0, from the scale factor at redshift z up to today:
+
+    - comoving: integral of da / (a^2 E(a))
+    - time: integral of da / (a E(a))
+
+    Both are evaluated in a single vectorized pass of composite Gauss-Legendre
+    quadrature over ln(a), with `panels` intervals of `order` nodes each, and cached
+    per set of parameters. The relative error is well below 1e-9 for the redshifts
+    used in the workshop.
+
+    Returns:
+    - Tuple with the comoving and the time integrals.
+    """
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+    edges = np.linspace(-np.log1p(z), 0, panels + 1)
+    half_width = np.diff(edges)[:, None] / 2
+    x = (edges[:-1, None] + half_width * (nodes + 1)).ravel()
+    w = (half_width * weights).ravel()
+
+    # with x = ln(a), da = a dx
+    a = np.exp(x)
+    e = E(a, Omega_m, Omega_lambda, Omega_r)
+    comoving = np.sum(w / (a * e))
+    time = np.sum(w / e)
+    return comoving, time
+
+def comoving_distance(H_0, z=z_recombination, densities=None):
+    """
+    Calculates the comoving distance to redshift z.
+
+    Parameters:
+    - H_0: Hubble constant (in km/s/Mpc), a number or an array.
+    - z: Redshift, defaults to recombination.
+    - densities: (Omega_m, Omega_lambda, Omega_r), defaults to Planck 2018.
+
+    Returns:
+    - The comoving distance (in Mpc), with the shape of H_0.
+    """
+    comoving, _ = dimensionless_integrals(*(densities or planck18_densities()), z)
+    return c_km_s * comoving / np.asarray(H_0, dtype=float)
+
+def travel_time(H_0, z=z_recombination, densities=None):
+    """
+    Calculates the time light emitted at redshift z travelled to reach us.
+
+    Parameters:
+    - H_0: Hubble constant (in km/s/Mpc), a number or an array.
+    - z: Redshift, defaults to recombination.
+    - densities: (Omega_m, Omega_lambda, Omega_r), defaults to Planck 2018.
+
+    Returns:
+    - The travel time (in billions of years), with the shape of H_0.
+    """
+    _, time = dimensionless_integrals(*(densities or planck18_densities()), z)
+    distance = c_km_s * time / np.asarray(H_0, dtype=float)
+    return distance / c_mpc_yr / 1e9
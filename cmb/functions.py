@@ -13,10 +13,60 @@ def blackbody_radiation(wavelength, temp):
     Returns:
     - Spectral radiance (in W/m^2/sr/m) of the black body.
     """
-    exponent_factor = np.exp(h * c / (wavelength * k * temp))
-    spectral_radiance = (2 * h * c**2) / (wavelength**5 * (exponent_factor - 1))
+    # expm1 keeps exp(x) - 1 accurate when x is small (long wavelengths, low temperatures)
+    exponent_factor = np.expm1(h * c / (wavelength * k * temp))
+    spectral_radiance = (2 * h * c**2) / (wavelength**5 * exponent_factor)
     return spectral_radiance
 
+class SpectralGrid:
+    """
+    Table of black body spectral radiance over a grid of temperatures and wavelengths,
+    built once with a single broadcast call to `blackbody_radiation`.
+
+    Temperatures on the grid are plain row lookups. Temperatures between two rows are
+    interpolated linearly in log(radiance) as a function of 1/temperature, which is
+    exact in the Wien limit. For any wavelength the relative error is bounded by
+    (dT / T)^2 / 8, where dT is the grid spacing around T: below 0.13% at 1000 K and
+    below 0.0013% at 10000 K for the default 100 K spacing. Temperatures outside the
+    grid are computed directly.
+    """
+
+    def __init__(self, wavelengths, temperatures=np.arange(1000, 10001, 100)):
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        self.temperatures = np.asarray(temperatures, dtype=float)
+        self.radiance = blackbody_radiation(self.wavelengths[None, :], self.temperatures[:, None])
+        self.log_radiance = np.log(self.radiance)
+
+    def __call__(self, temp):
+        """
+        Returns the spectral radiance (in W/m^2/sr/m) at every wavelength of the grid
+        for a temperature (in Kelvin).
+        """
+        temperatures = self.temperatures
+        if temp < temperatures[0] or temp > temperatures[-1]:
+            return blackbody_radiation(self.wavelengths, temp)
+
+        i = np.searchsorted(temperatures, temp)
+        if temperatures[i] == temp:
+            return self.radiance[i]
+
+        weight = (1 / temp - 1 / temperatures[i - 1]) / (1 / temperatures[i] - 1 / temperatures[i - 1])
+        return np.exp((1 - weight) * self.log_radiance[i - 1] + weight * self.log_radiance[i])
+
+# spectral grids already built, keyed by their wavelengths
+spectral_grids = {}
+
+def spectral_grid(wavelengths):
+    """
+    Returns the `SpectralGrid` for the given wavelengths (in meters), building it on
+    first use.
+    """
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    key = (wavelengths.shape, wavelengths.tobytes())
+    if key not in spectral_grids:
+        spectral_grids[key] = SpectralGrid(wavelengths)
+    return spectral_grids[key]
+
 def peak_wavelength(temp):
     """
     Calculates the peak wavelength of black body radiation for a given temperature using Wien's Law.
@@ -1,7 +1,11 @@
 import os
 import re
 import json
-from IPython.display import display, Markdown
+
+from . import lazy_function
+
+display = lazy_function("IPython.display", "display")
+Markdown = lazy_function("IPython.display", "Markdown")
 
 class I18N:
     _instance = None  # Private class variable to hold the singleton instance
@@ -1,8 +1,10 @@
-import matplotlib.pyplot as plt
-from astropy.visualization import astropy_mpl_style
+from . import lazy_import
+
+plt = lazy_import("matplotlib.pyplot")
+visualization = lazy_import("astropy.visualization")
 
 def set_custom_layout(large: bool=False, figsize=(16, 8)) -> None:
-    plt.style.use(astropy_mpl_style)
+    plt.style.use(visualization.astropy_mpl_style)
 
     # Global settings for plots
 
@@ -1,11 +1,17 @@
+import weakref
+
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
 
 from .i18n import I18N
 i18n = I18N()
 
-from . import functions, const, cmb_utils
+from . import functions, const, cmb_utils, profiling, lazy_import, lazy_function
+
+matplotlib = lazy_import("matplotlib")
+plt = lazy_import("matplotlib.pyplot")
+patches = lazy_import("matplotlib.patches")
+colors = lazy_import("matplotlib.colors")
+display = lazy_function("IPython.display", "display")
 
 PROVIDED_COLOR = 'C0'
 STUDENT_COLOR = 'C1'
@@ -13,116 +19,71 @@ REFERENCE_COLOR = 'C2'
 
 COLOR1, COLOR2, COLOR3 = 'C3', 'C4', 'C5' 
 
-def blackbody_plot(wavelengths, ref_name, ref_temp, temp, bb_student_fn):
-    ref_radiance = np.array([functions.blackbody_radiation(wavelength, ref_temp) for wavelength in wavelengths])
-    
-    # Calculate spectral radiance using the provided function
-    provided_radiance = np.array([functions.blackbody_radiation(wavelength, temp) for wavelength in wavelengths])
-    
-    # Attempt to calculate spectral radiance using the student's function
-    student_radiance = np.array([bb_student_fn(wavelength, temp) for wavelength in wavelengths])
-
-    # Plot provided function results
-    plt.plot(
-        wavelengths * 1e9,
-        provided_radiance,
-        label=i18n.gettext("provided_blackbody_function"),
-        c=PROVIDED_COLOR
-    )
-    
-    # Plot reference results
-    plt.plot(
-        wavelengths * 1e9,
-        ref_radiance,
-        label=i18n.gettext("reference_blackbody_function").format(ref_name),
-        linestyle='--',
-        c=REFERENCE_COLOR
-    )
+# whether each student function was found to accept an array of wavelengths
+array_support = weakref.WeakKeyDictionary()
 
-    # Check if the student function returns valid results and plot if so
-    if np.any(student_radiance != None):
-        plt.plot(
-            wavelengths * 1e9,
-            student_radiance,
-            label=i18n.gettext("student_blackbody_function"),
-            c=STUDENT_COLOR
-        )
+@profiling.profiled
+def spectral_radiance(fn, wavelengths, temp):
+    """
+    Evaluates a black body function over all the wavelengths at once.
 
-    plt.title(i18n.gettext("blackbody_spectrum_title").format(temp))
-    plt.xlabel(i18n.gettext("xlabel_wavelength"))
-    plt.ylabel(i18n.gettext("ylabel_spectral_radiance"))
-    plt.legend(loc='upper right')
-    plt.grid(True)
+    The function is first called with the whole array. Functions that fail or don't
+    return one value per wavelength (e.g. a student's implementation using math.exp,
+    or one that isn't implemented yet) are called once per wavelength instead, and
+    are remembered so they aren't probed again.
 
-def blackbody_radiation(wavelengths, ref_name, ref_temp, temp, student_fn):
-    """
-    Plots the spectral radiance of a black body at given wavelengths and temperature,
-    using both a provided reference function and the student's function.
-    
     Parameters:
-    - wavelengths: Array of wavelengths (in meters) to plot.
-    - ref_name: Name of a reference object.
-    - ref_temp: Temperature of a reference object (in Kelvin).
+    - fn: Black body function taking a wavelength (in meters) and a temperature (in Kelvin).
+    - wavelengths: Array of wavelengths (in meters).
     - temp: Temperature of the black body (in Kelvin).
-    - student_fn: Student's implementation of the black body radiation law.
-    """
 
-    blackbody_plot(wavelengths, ref_name, ref_temp, temp, student_fn)
-    
-    plt.show()
-
-def peak_wavelength(wavelengths, ref_name, ref_temp, temp, bb_student_fn, wl_student_fn):
+    Returns:
+    - Array with the spectral radiance at each wavelength.
     """
-    Plots the spectral radiance of a black body at given wavelengths and temperature,
-    using both a provided reference function and the student's function, highlighting its peak.
+    if array_support.get(fn, True):
+        try:
+            radiance = fn(wavelengths, temp)
+            if np.shape(radiance) == np.shape(wavelengths):
+                array_support[fn] = True
+                return np.asarray(radiance)
+        except Exception:
+            pass
+        array_support[fn] = False
+    return np.array([fn(wavelength, temp) for wavelength in wavelengths])
+
+@profiling.profiled
+def blackbody_heatmap(wavelengths, temp=None):
+    """
+    Plots the spectral radiance of a black body as a heatmap of temperature versus
+    wavelength, optionally highlighting one temperature.
     
     Parameters:
     - wavelengths: Array of wavelengths (in meters) to plot.
-    - ref_name: Name of a reference object.
-    - ref_temp: Temperature of a reference object (in Kelvin).
-    - temp: Temperature of the black body (in Kelvin).
-    - bb_student_fn: Student's implementation of the blackbody radiation.
-    - wl_student_fn: Student's implementation of the Wien's law.
+    - temp: Temperature (in Kelvin) to highlight.
     """
-    
-    blackbody_plot(wavelengths, ref_name, ref_temp, temp, bb_student_fn)
-
-    # Calculate and plot the peak wavelength using the reference function
-    peak_wavelength = functions.peak_wavelength(temp)
-    peak_radiance = functions.blackbody_radiation(peak_wavelength, temp)
-    plt.scatter(peak_wavelength * 1e9, peak_radiance, c=PROVIDED_COLOR, s=100, zorder=5,
-                label=i18n.gettext("provided_peak_wavelength"))
-    plt.annotate(
-        i18n.gettext("provided_peak_annotation").format(peak_wavelength * 1e9),
-        xy=(peak_wavelength * 1e9, peak_radiance),
-        xytext=(peak_wavelength * 1e9 * 1.5, peak_radiance * 0.7),
-        textcoords='data',
-        arrowprops=dict(arrowstyle='->', color=PROVIDED_COLOR)
+    grid = functions.spectral_grid(wavelengths)
+
+    fig, ax = plt.subplots()
+    mesh = ax.pcolormesh(
+        grid.wavelengths * 1e9,
+        grid.temperatures,
+        grid.radiance,
+        norm=colors.LogNorm(vmin=grid.radiance.max() * 1e-6, vmax=grid.radiance.max()),
+        shading='nearest',
+        cmap='inferno'
     )
+    fig.colorbar(mesh, ax=ax, label=i18n.gettext("ylabel_spectral_radiance"))
 
-    # Plot the student's calculated peak wavelength if available
-    student_peak_wavelength = wl_student_fn(temp)
-    if student_peak_wavelength is not None:
-        student_peak_radiance = bb_student_fn(student_peak_wavelength, temp)
-        if student_peak_radiance is not None:
-            plt.scatter(student_peak_wavelength * 1e9, student_peak_radiance, c=STUDENT_COLOR, s=100, marker='*', zorder=6,
-                        label=i18n.gettext("student_peak_wavelength"))
-            plt.annotate(
-                i18n.gettext("student_peak_annotation").format(student_peak_wavelength * 1e9),
-                xy=(student_peak_wavelength * 1e9, student_peak_radiance),
-                xytext=(student_peak_wavelength * 1e9 * 1.3, student_peak_radiance * 0.9),
-                textcoords='data',
-                arrowprops=dict(arrowstyle='->', color=STUDENT_COLOR)
-            )
-
-    # Define spectral regions with labels
-    plt.axvspan(0, 400, color='violet', alpha=0.2, label=i18n.gettext("ultraviolet_region"))
-    plt.axvspan(400, 700, color='yellow', alpha=0.2, label=i18n.gettext("visible_light_region"))
-    plt.axvspan(700, 2000, color='red', alpha=0.2, label=i18n.gettext("infrared_region"))
+    if temp is not None:
+        ax.axhline(temp, color='white', linestyle='--')
 
-    plt.legend(loc='upper right')
+    ax.set_title(i18n.gettext("blackbody_heatmap_title"))
+    ax.set_xlabel(i18n.gettext("xlabel_wavelength"))
+    ax.set_ylabel(i18n.gettext("ylabel_temperature_kelvin"))
+    ax.grid(False)
     plt.show()
 
+@profiling.profiled
 def visibile_wavelengths():
     # Defining the visible light spectrum in nm and their corresponding colors
     wavelengths = [400, 450, 495, 570, 590, 620, 700]
@@ -160,71 +121,225 @@ def visibile_wavelengths():
 
     plt.show()
 
-def cobe_curve_fit(temp, bb_student_fn, output):
+def live_backend():
+    """ Whether figures are interactive canvases (ipympl) that can be redrawn in place """
+    return "ipympl" in matplotlib.get_backend()
+
+class LivePlot:
+    """
+    Figure that is created once and then updated in place on every interaction.
+
+    Subclasses create their artists in `setup` and only change their data (line data,
+    scatter offsets, annotation positions, titles) in `update`, both called with the
+    arguments given to `draw`. With the ipympl backend the canvas redraws itself in
+    place. Otherwise the cached figure is rendered again into the output, which still
+    skips building a new figure, axes, spans and legend on every change.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.fig = None
+        self.ax = None
+
+    @profiling.profiled
+    def draw(self, *args):
+        if self.fig is None:
+            with plt.ioff():
+                self.fig, self.ax = plt.subplots()
+            self.setup(*args)
+            self.update(*args)
+
+            if live_backend():
+                with self.output:
+                    self.output.clear_output(wait=True)
+                    display(self.fig.canvas)
+                return
+            # the figure is displayed into the output below, keep pyplot from
+            # showing it again at the end of the cell
+            plt.close(self.fig)
+        else:
+            self.update(*args)
+
+        if live_backend():
+            self.fig.canvas.draw_idle()
+        else:
+            with self.output:
+                self.output.clear_output(wait=True)
+                display(self.fig)
 
-    with output:
-        output.clear_output(wait=True)
+    def setup(self, *args):
+        raise NotImplementedError
 
+    def update(self, *args):
+        raise NotImplementedError
+
+    def rescale(self):
+        self.ax.relim(visible_only=True)
+        self.ax.autoscale_view()
+
+class BlackbodyPlot(LivePlot):
+    """
+    Spectral radiance of a black body at the given wavelengths and temperature, from
+    both the provided function and the student's function, with a reference object.
+    Drawn with (wavelengths, ref_name, ref_temp, temp, student_fn), wavelengths in meters
+    and temperatures in Kelvin.
+    """
+
+    def setup(self, wavelengths, ref_name, ref_temp, temp, student_fn):
+        ax = self.ax
+        x = wavelengths * 1e9
+        # the y data is only a placeholder until the first update
+        self.provided_line, = ax.plot(x, x, label=i18n.gettext("provided_blackbody_function"), c=PROVIDED_COLOR)
+        self.reference_line, = ax.plot(x, x, linestyle='--', c=REFERENCE_COLOR)
+        self.student_line, = ax.plot(x, x, c=STUDENT_COLOR)
+
+        ax.set_xlabel(i18n.gettext("xlabel_wavelength"))
+        ax.set_ylabel(i18n.gettext("ylabel_spectral_radiance"))
+        ax.grid(True)
+
+    def update(self, wavelengths, ref_name, ref_temp, temp, student_fn):
+        self.update_curves(wavelengths, ref_name, ref_temp, temp, student_fn)
+        self.rescale()
+        self.ax.legend(loc='upper right')
+
+    def update_curves(self, wavelengths, ref_name, ref_temp, temp, student_fn):
+        grid = functions.spectral_grid(wavelengths)
+        self.provided_line.set_ydata(grid(temp))
+        self.reference_line.set_ydata(grid(ref_temp))
+        self.reference_line.set_label(i18n.gettext("reference_blackbody_function").format(ref_name))
+
+        student_radiance = spectral_radiance(student_fn, wavelengths, temp)
+        implemented = np.any(student_radiance != None)
+        if implemented:
+            self.student_line.set_ydata(student_radiance)
+        self.student_line.set_visible(implemented)
+        self.student_line.set_label(i18n.gettext("student_blackbody_function") if implemented else '_hidden')
+
+        self.ax.set_title(i18n.gettext("blackbody_spectrum_title").format(temp))
+
+class PeakWavelengthPlot(BlackbodyPlot):
+    """
+    `BlackbodyPlot` highlighting the peak wavelength from the provided function and
+    from the student's implementation of Wien's law, over the ultraviolet, visible and
+    infrared regions. Drawn with (wavelengths, ref_name, ref_temp, temp, bb_student_fn,
+    wl_student_fn).
+    """
+
+    def setup(self, wavelengths, ref_name, ref_temp, temp, bb_student_fn, wl_student_fn):
+        super().setup(wavelengths, ref_name, ref_temp, temp, bb_student_fn)
+        ax = self.ax
+
+        self.provided_peak = ax.scatter([], [], c=PROVIDED_COLOR, s=100, zorder=5,
+                                        label=i18n.gettext("provided_peak_wavelength"))
+        self.provided_annotation = ax.annotate(
+            '', xy=(0, 0), xytext=(0, 0), textcoords='data',
+            arrowprops=dict(arrowstyle='->', color=PROVIDED_COLOR)
+        )
+        self.student_peak = ax.scatter([], [], c=STUDENT_COLOR, s=100, marker='*', zorder=6)
+        self.student_annotation = ax.annotate(
+            '', xy=(0, 0), xytext=(0, 0), textcoords='data',
+            arrowprops=dict(arrowstyle='->', color=STUDENT_COLOR)
+        )
+
+        # Define spectral regions with labels
+        ax.axvspan(0, 400, color='violet', alpha=0.2, label=i18n.gettext("ultraviolet_region"))
+        ax.axvspan(400, 700, color='yellow', alpha=0.2, label=i18n.gettext("visible_light_region"))
+        ax.axvspan(700, 2000, color='red', alpha=0.2, label=i18n.gettext("infrared_region"))
+
+    def update(self, wavelengths, ref_name, ref_temp, temp, bb_student_fn, wl_student_fn):
+        self.update_curves(wavelengths, ref_name, ref_temp, temp, bb_student_fn)
+
+        peak_wavelength = functions.peak_wavelength(temp)
+        peak_radiance = functions.blackbody_radiation(peak_wavelength, temp)
+        self.provided_peak.set_offsets([[peak_wavelength * 1e9, peak_radiance]])
+        self.provided_annotation.set_text(i18n.gettext("provided_peak_annotation").format(peak_wavelength * 1e9))
+        self.provided_annotation.xy = (peak_wavelength * 1e9, peak_radiance)
+        self.provided_annotation.set_position((peak_wavelength * 1e9 * 1.5, peak_radiance * 0.7))
+
+        student_peak_wavelength = wl_student_fn(temp)
+        student_peak_radiance = None
+        if student_peak_wavelength is not None:
+            student_peak_radiance = bb_student_fn(student_peak_wavelength, temp)
+        implemented = student_peak_radiance is not None
+        if implemented:
+            self.student_peak.set_offsets([[student_peak_wavelength * 1e9, student_peak_radiance]])
+            self.student_annotation.set_text(
+                i18n.gettext("student_peak_annotation").format(student_peak_wavelength * 1e9)
+            )
+            self.student_annotation.xy = (student_peak_wavelength * 1e9, student_peak_radiance)
+            self.student_annotation.set_position(
+                (student_peak_wavelength * 1e9 * 1.3, student_peak_radiance * 0.9)
+            )
+        self.student_peak.set_visible(implemented)
+        self.student_peak.set_label(i18n.gettext("student_peak_wavelength") if implemented else '_hidden')
+        self.student_annotation.set_visible(implemented)
+
+        self.rescale()
+        self.ax.legend(loc='upper right')
+
+class CobeFitPlot(LivePlot):
+    """
+    COBE/FIRAS measurements of the CMB spectrum with the black body curve at a
+    temperature, from the student's function or the provided one if it is not
+    implemented yet. Drawn with (temp, bb_student_fn).
+    """
+
+    def setup(self, temp, bb_student_fn):
+        ax = self.ax
         data = const.cmb_cobes
-        frequencies = data[:, 0]
-        intensities = data[:, 1]
-        wavelengths = np.array([functions.convert_to_freq_cm(freq) for freq in frequencies])
+        self.frequencies = data[:, 0]
+        self.wavelengths = functions.convert_to_freq_cm(self.frequencies)
 
-        plt.scatter(frequencies, intensities, color=PROVIDED_COLOR, label=i18n.gettext("cobe_data_label"))
+        ax.scatter(self.frequencies, data[:, 1], color=PROVIDED_COLOR, label=i18n.gettext("cobe_data_label"))
+        self.line, = ax.plot(self.frequencies, data[:, 1])
+
+        ax.set_title(i18n.gettext("cobe_spectrum_title"))
+        ax.set_xlabel(i18n.gettext("xlabel_frequency"))
+        ax.set_ylabel(i18n.gettext("ylabel_intensity"))
+        ax.grid(True)
+
+    def update(self, temp, bb_student_fn):
+        student_radiance = spectral_radiance(bb_student_fn, self.wavelengths, temp)
 
-        provided_radiance = np.array([functions.blackbody_radiation(wavelength, temp) for wavelength in wavelengths])
-        student_radiance = np.array([bb_student_fn(wavelength, temp) for wavelength in wavelengths])
-        
         if np.any(student_radiance != None):
-            intensity_mjy_sr = np.array([
-                functions.convert_to_mjy_sr(sr, wl) for sr, wl in zip(student_radiance, wavelengths)
-            ])
-            plt.plot(frequencies, intensity_mjy_sr, label=i18n.gettext("student_blackbody_function"), c=STUDENT_COLOR)
+            intensity_mjy_sr = functions.convert_to_mjy_sr(student_radiance, self.wavelengths)
+            self.line.set_label(i18n.gettext("student_blackbody_function"))
+            self.line.set_color(STUDENT_COLOR)
         else:
-            intensity_mjy_sr = np.array([
-                functions.convert_to_mjy_sr(sr, wl) for sr, wl in zip(provided_radiance, wavelengths)
-            ])
-            plt.plot(frequencies, intensity_mjy_sr, label=i18n.gettext("provided_blackbody_function"), c=PROVIDED_COLOR)
-
-        plt.title(i18n.gettext("cobe_spectrum_title"))
-        plt.xlabel(i18n.gettext("xlabel_frequency"))
-        plt.ylabel(i18n.gettext("ylabel_intensity"))
-        plt.legend()
-        plt.grid(True)
-        plt.show()
-
-def redshift_visualization(velocity, output):
-    with output:
-        output.clear_output(wait=True)
-
-        # Constants
-        c = 3e8  # Speed of light in m/s
-        initial_wavelength = 500  # Initial wavelength in nm (green light)
-        
-        # Calculate the shifted wavelength
-        shifted_wavelength = initial_wavelength * np.sqrt((1 + velocity/c) / (1 - velocity/c))
-        
-        # Plotting the initial and shifted spectrum
-        fig, ax = plt.subplots()
-        
-        # Initial spectrum
-        x_initial = np.linspace(400, 700, 1000)
-        y_initial = np.exp(-0.5 * ((x_initial - initial_wavelength) / 10)**2)
-        ax.plot(x_initial, y_initial, label=i18n.gettext("initial_spectrum_label"), color='green')
-        
-        # Shifted spectrum
-        y_shifted = np.exp(-0.5 * ((x_initial - shifted_wavelength) / 10)**2)
-        ax.plot(
-            x_initial,
-            y_shifted,
-            label=i18n.gettext("shifted_spectrum_label"),
-            color='red' if velocity > 0 else 'blue'
-        )
-        
-        # Adding labels and legend
+            provided_radiance = functions.blackbody_radiation(self.wavelengths, temp)
+            intensity_mjy_sr = functions.convert_to_mjy_sr(provided_radiance, self.wavelengths)
+            self.line.set_label(i18n.gettext("provided_blackbody_function"))
+            self.line.set_color(PROVIDED_COLOR)
+        self.line.set_ydata(intensity_mjy_sr)
+
+        self.rescale()
+        self.ax.legend()
+
+class RedshiftPlot(LivePlot):
+    """
+    Spectrum of green light shifted by the Doppler effect of a galaxy moving at a
+    velocity (in m/s, positive when moving away). Drawn with (velocity).
+    """
+
+    initial_wavelength = 500  # Initial wavelength in nm (green light)
+
+    def setup(self, velocity):
+        ax = self.ax
+        self.x = np.linspace(400, 700, 1000)
+        y_initial = np.exp(-0.5 * ((self.x - self.initial_wavelength) / 10)**2)
+        ax.plot(self.x, y_initial, label=i18n.gettext("initial_spectrum_label"), color='green')
+        self.shifted_line, = ax.plot(self.x, y_initial, label=i18n.gettext("shifted_spectrum_label"))
+
         ax.set_xlabel(i18n.gettext("xlabel_wavelength"))
         ax.set_ylabel(i18n.gettext("ylabel_intensity"))
-        ax.legend()
+
+    def update(self, velocity):
+        c = 3e8  # Speed of light in m/s
+        shifted_wavelength = self.initial_wavelength * np.sqrt((1 + velocity/c) / (1 - velocity/c))
+        self.shifted_line.set_ydata(np.exp(-0.5 * ((self.x - shifted_wavelength) / 10)**2))
+        self.shifted_line.set_color('red' if velocity > 0 else 'blue')
+        # the legend copies the line colors, so it is rebuilt
+        self.ax.legend()
 
         # Format the velocity as powers of ten
         if velocity == 0:
@@ -233,24 +348,24 @@ def redshift_visualization(velocity, output):
             exponent = int(np.log10(abs(velocity)))
             base = velocity / 10**exponent
             velocity_power_ten = "{:.2f} x $10^{}$".format(base, exponent)
-        
-        # Set the title based on movement direction
+
         movement_key = "galaxy_moving_away" if velocity > 0 else "galaxy_moving_towards"
-        ax.set_title(i18n.gettext(movement_key).format(velocity_power_ten))
+        self.ax.set_title(i18n.gettext(movement_key).format(velocity_power_ten))
 
-        plt.show()
+@profiling.profiled
+def planck_map(map, box=None):
+    cmb_utils.view_map(map, box=box)
 
-def planck_map(map):
-    cmb_utils.view_map(map)
+@profiling.profiled
+def cmb_std_dev(data, show_guidelines=False, stats=None, bins=100):
 
-def cmb_std_dev(data, show_guidelines=False):
+    if stats is None:
+        stats = cmb_utils.map_statistics(data)
 
-    mean = np.mean(data)
-    std = np.std(data)
-    
-    flattened_data = data.flatten()
+    mean = stats.mean
+    std = stats.std
     
-    plt.hist(flattened_data, bins=100, alpha=0.7)
+    plt.stairs(*stats.histogram(bins), fill=True, alpha=0.7)
     
     plt.axvline(mean, color='blue', linestyle='--', label=i18n.gettext("mean_label"))
     
@@ -274,12 +389,13 @@ def cmb_std_dev(data, show_guidelines=False):
     plt.grid(False)
 
     # Set the x-ticks with the central tick at 0 and others around it
-    max_tick = max(abs(data.min()), data.max())
+    max_tick = max(abs(stats.min), stats.max)
     ticks = np.arange(-max_tick, max_tick, std)
     plt.xticks(ticks, labels=[f'{tick*1e6:.2f}' for tick in ticks])
 
     plt.show()
 
+@profiling.profiled
 def averaged_hotspot_horizontal_profile(mean_img, threshold=0.3):
 
     center_index = mean_img.shape[0] // 2
@@ -322,11 +438,23 @@ def averaged_hotspot_horizontal_profile(mean_img, threshold=0.3):
 
     return start_index, end_index
 
-def averaged_hotspot_radial_profile(mean_img, threshold=0.3):
+@profiling.profiled
+def averaged_hotspot_radial_profile(mean_img, threshold=0.3, interval=None):
+    """
+    Plots the radial profile of the averaged hot spot and returns the radius at which
+    it drops below `threshold` times its peak, the centre of the first bin at or below
+    it. `interval` is an optional (size, low, high) confidence interval of that radius
+    (see `stacking.hotspot_size_interval`), drawn as a shaded band; it is interpolated
+    between the bins, so it doesn't snap to the bin centres.
+    """
     radius, profile = cmb_utils.extract_profile(mean_img)
     peak_threshold = threshold * np.max(profile)
-    index_threshold = np.where(profile <= peak_threshold)[0][0]
-    radius_threshold = radius[index_threshold]
+    below = np.flatnonzero(profile <= peak_threshold)
+    if len(below):
+        radius_threshold, value_threshold = radius[below[0]], profile[below[0]]
+    else:
+        # the profile doesn't drop to the threshold within the thumbnail
+        radius_threshold, value_threshold = np.nan, peak_threshold
 
     plt.plot(radius, profile)
     plt.xlabel(i18n.gettext("radius_label"))
@@ -338,10 +466,13 @@ def averaged_hotspot_radial_profile(mean_img, threshold=0.3):
         alpha=0.3,
         label=f'{threshold*100:.0f}% ' + i18n.gettext("peak_value_threshold")
     )
+    if interval is not None:
+        _, low, high = interval
+        plt.axvspan(low, high, color='gray', alpha=0.2, label=i18n.gettext("size_interval_label"))
     plt.annotate(
         f'{radius_threshold:.4f} ' + i18n.gettext("degree_unit"), 
-        xy=(radius_threshold, profile[index_threshold]), 
-        xytext=(radius_threshold, profile[index_threshold] + 5),
+        xy=(radius_threshold, value_threshold), 
+        xytext=(radius_threshold, value_threshold + 5),
         arrowprops=dict(facecolor='black', arrowstyle='->')
     )
     plt.title(i18n.gettext("radial_profile_title"))
@@ -350,7 +481,9 @@ def averaged_hotspot_radial_profile(mean_img, threshold=0.3):
 
     return radius_threshold
 
+@profiling.profiled
 def view_map_pixel(imap, circle=None, size=(4,4)):
+    cmb_utils.register_colormap()
     fig, ax = plt.subplots(figsize=size)
     ax.imshow(imap, origin='lower', cmap='planck')
 
@@ -374,9 +507,11 @@ def view_map_pixel(imap, circle=None, size=(4,4)):
     plt.grid(False)
     plt.show()
 
+@profiling.profiled
 def view_map_degrees(imap, radius=None, size=(4, 4)):
     wcs = imap.wcs
 
+    cmb_utils.register_colormap()
     fig, ax = plt.subplots(figsize=size, subplot_kw={'projection': wcs})
     ax.imshow(imap.data, origin='lower', cmap='planck')
 
@@ -0,0 +1,188 @@
+"""
+Opt-in profiling of the widget callbacks and of the cmb_utils and plot functions.
+
+Functions decorated with `profiled`, and blocks wrapped in `stage`, record their wall
+time (and, when enabled with memory=True, their peak memory according to tracemalloc)
+into a ring buffer holding the latest `size` records:
+
+    from cmb import profiling
+    profiling.enable()
+    ...  # use the widgets
+    profiling.report()
+    profiling.export_chrome_trace("trace.json")  # open in chrome://tracing or Perfetto
+
+Profiling is disabled by default, and then a decorated function only costs one extra
+call and a flag check.
+"""
+import os
+import json
+import time
+import functools
+import threading
+import tracemalloc
+from collections import deque
+
+enabled = False
+# (name, start, duration, thread, peak) of the latest calls, times in nanoseconds
+records = deque(maxlen=10000)
+# stages running on each thread, innermost last
+running = threading.local()
+
+def enable(memory=False, size=10000):
+    """
+    Starts recording, keeping the latest `size` records. With `memory=True`, tracemalloc
+    is started too and each record includes the peak memory of the call (see `stage`),
+    at the price of making everything noticeably slower.
+    """
+    global enabled, records
+    if size != records.maxlen:
+        records = deque(records, maxlen=size)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    enabled = True
+
+def disable():
+    """ Stops recording, and tracemalloc if it is running. The records are kept. """
+    global enabled
+    enabled = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def clear():
+    records.clear()
+
+class stage:
+    """
+    Context manager recording the block it wraps under `name`:
+
+        with profiling.stage("render"):
+            ...
+
+    With memory tracing, the record includes the peak of the traced memory during the
+    block, in bytes above the memory in use when it started. tracemalloc has a single
+    peak for the whole process, which every stage resets when it starts; the peaks seen
+    by nested stages are carried over to the stages around them. Allocations made by
+    other threads meanwhile count too, and their stages reset the same peak, so the
+    peaks of stages overlapping on several threads are only approximate.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.active = enabled
+        if self.active:
+            self.memory = None
+            if tracemalloc.is_tracing():
+                stack = running.__dict__.setdefault("stack", [])
+                current, peak = tracemalloc.get_traced_memory()
+                # the peak is about to be reset, the enclosing stages keep it
+                for outer in stack:
+                    outer.peak = max(outer.peak, peak)
+                tracemalloc.reset_peak()
+                self.memory = self.peak = current
+                stack.append(self)
+            self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        if self.active:
+            duration = time.perf_counter_ns() - self.start
+            peak = None
+            if self.memory is not None:
+                running.stack.remove(self)
+                if tracemalloc.is_tracing():
+                    self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+                    peak = self.peak - self.memory
+                    for outer in running.stack:
+                        outer.peak = max(outer.peak, self.peak)
+            records.append((self.name, self.start, duration, threading.get_ident(), peak))
+        return False
+
+def profiled(fn):
+    """
+    Decorator recording every call of `fn` under its qualified name, e.g.
+    "cmb.cmb_utils.find_maxima" or "cmb.widgets.redshift.<locals>.update_plot".
+    """
+    name = f"{fn.__module__}.{fn.__qualname__}"
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return fn(*args, **kwargs)
+        with stage(name):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+def summary():
+    """
+    Aggregates the records per name.
+
+    Returns:
+    - List of dictionaries with the name, number of calls, total, mean and max time
+      (in milliseconds) and the largest peak memory of a call in bytes (None without
+      memory tracing), sorted by decreasing total time. `pandas.DataFrame(summary())` turns it into a
+      data frame.
+    """
+    stats = {}
+    for name, _, duration, _, peak in list(records):
+        entry = stats.setdefault(name, {"calls": 0, "total": 0, "max": 0, "peak": None})
+        entry["calls"] += 1
+        entry["total"] += duration
+        entry["max"] = max(entry["max"], duration)
+        if peak is not None:
+            entry["peak"] = max(entry["peak"] or 0, peak)
+
+    rows = [
+        {
+            "name": name,
+            "calls": entry["calls"],
+            "total_ms": entry["total"] / 1e6,
+            "mean_ms": entry["total"] / entry["calls"] / 1e6,
+            "max_ms": entry["max"] / 1e6,
+            "peak_bytes": entry["peak"],
+        }
+        for name, entry in stats.items()
+    ]
+    return sorted(rows, key=lambda row: row["total_ms"], reverse=True)
+
+def report():
+    """
+    Prints the `summary` as a table and returns it. Times of nested calls are included
+    in the times of their callers.
+    """
+    rows = summary()
+    width = max([len(row["name"]) for row in rows] + [4])
+    print(f"{'name':<{width}} {'calls':>7} {'total [ms]':>11} {'mean [ms]':>10} {'max [ms]':>10} {'peak [MB]':>10}")
+    for row in rows:
+        peak = "" if row["peak_bytes"] is None else f"{row['peak_bytes'] / 2**20:.2f}"
+        print(f"{row['name']:<{width}} {row['calls']:>7} {row['total_ms']:>11.2f} "
+              f"{row['mean_ms']:>10.2f} {row['max_ms']:>10.2f} {peak:>10}")
+    return rows
+
+def chrome_trace():
+    """
+    The records in the Chrome trace event format, as complete ("X") events, one
+    track per thread.
+    """
+    events = []
+    for name, start, duration, thread, peak in list(records):
+        event = {
+            "name": name,
+            "cat": "cmb",
+            "ph": "X",
+            "ts": start / 1e3,
+            "dur": duration / 1e3,
+            "pid": os.getpid(),
+            "tid": thread,
+        }
+        if peak is not None:
+            event["args"] = {"peak_bytes": peak}
+        events.append(event)
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+def export_chrome_trace(filename):
+    """ Writes the records to `filename` as Chrome trace JSON """
+    with open(filename, "w") as f:
+        json.dump(chrome_trace(), f)
@@ -0,0 +1,371 @@
+"""
+Records the interactions of a notebook session with the widgets into a JSON trace,
+and replays it headlessly to measure the latency of every interaction.
+
+Recording, in the notebook:
+
+    from cmb import replay, widgets
+    recorder = replay.TraceRecorder()
+    recorder.start()
+    widgets.cmb_thumbnails_averaging()  # ... and the rest of the session
+    recorder.stop()
+    recorder.save("session.json")
+
+Replaying, from the repository root (on the Agg backend, no browser needed):
+
+    python -m cmb.replay session.json --repeat 5
+    python -m cmb.replay session.json --synthetic 0.25  # on a synthetic map
+
+The trace holds the calls made to the functions of `cmb.widgets` and the messages
+the browser sent to the widgets they created, in order: trait changes (slider moves,
+typed values, dropdown selections) and custom messages (button clicks). Widgets are
+identified by their order of creation, which is the same on every run of the same
+calls. The replay times the widget function calls and every message, up to the end
+of the redraw. Without a running event loop the update schedulers run right away, so
+the measured latency is the work done for an interaction, without the debounce delay.
+
+Each replay starts cold by default: the caches the package keeps across calls
+(thumbnails, map statistics, pyramids, splines, spectral grids...) are emptied first,
+like in a freshly started kernel. With `--warm` they are kept, and the replays
+measure a session that has already been through the same interactions.
+"""
+import io
+import sys
+import json
+import time
+import argparse
+import importlib
+import contextlib
+
+import numpy as np
+from ipywidgets import Widget
+
+def encode(value):
+    """ JSON friendly version of the arguments of a widget function """
+    if callable(value):
+        return {"callable": f"{value.__module__}:{value.__qualname__}"}
+    if isinstance(value, np.ndarray):
+        return {"array": value.tolist()}
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    if isinstance(value, dict):
+        return {key: encode(item) for key, item in value.items()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def decode(value, callables=None):
+    """
+    Reverses `encode`. Callables are looked up in `callables` by their "module:name"
+    reference, then imported. Functions that can't be imported, like the students'
+    functions defined in the notebook, are replaced by one returning None, the same
+    as a function that is not implemented yet.
+    """
+    if isinstance(value, dict):
+        if set(value) == {"callable"}:
+            return resolve(value["callable"], callables or {})
+        if set(value) == {"array"}:
+            return np.array(value["array"])
+        return {key: decode(item, callables) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode(item, callables) for item in value]
+    return value
+
+def resolve(reference, callables):
+    if reference in callables:
+        return callables[reference]
+    module, _, name = reference.partition(":")
+    try:
+        target = importlib.import_module(module)
+        for part in name.split("."):
+            target = getattr(target, part)
+        return target
+    except (ImportError, AttributeError):
+        return lambda *args, **kwargs: None
+
+def widget_label(widget, function):
+    description = getattr(widget, "description", "") or ""
+    return f"{function}/{type(widget).__name__}" + (f":{description}" if description else "")
+
+class WidgetTracker:
+    """
+    Hooks into the creation of widgets and the calls of the `cmb.widgets` functions,
+    numbering the widgets in their order of creation and remembering the top level
+    widget function that created each one.
+    """
+
+    def __init__(self):
+        self.widgets = []
+        # by id(), the widgets have no comm without a kernel; they are kept alive in
+        # self.widgets, so the ids are not reused
+        self.ids = {}
+        self.functions = {}
+        self.function = None
+        self.depth = 0
+        self.patched = {}
+        self.previous_callback = None
+
+    def install(self, on_call=None):
+        from . import widgets
+
+        self.previous_callback = Widget._widget_construction_callback
+        Widget.on_widget_constructed(self.constructed)
+
+        for name, fn in vars(widgets).items():
+            if callable(fn) and getattr(fn, "__module__", None) == widgets.__name__ and not isinstance(fn, type):
+                self.patched[name] = fn
+                setattr(widgets, name, self.wrap(name, fn, on_call))
+
+    def uninstall(self):
+        from . import widgets
+
+        Widget.on_widget_constructed(self.previous_callback)
+        for name, fn in self.patched.items():
+            setattr(widgets, name, fn)
+        self.patched = {}
+
+    def wrap(self, name, fn, on_call):
+        def wrapper(*args, **kwargs):
+            # only the calls made from the notebook matter, the widget functions
+            # call each other
+            top = self.depth == 0
+            if top:
+                self.function = name
+                if on_call is not None:
+                    on_call(name, args, kwargs)
+            self.depth += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.depth -= 1
+        return wrapper
+
+    def constructed(self, widget):
+        self.ids[id(widget)] = len(self.widgets)
+        self.functions[len(self.widgets)] = self.function
+        self.widgets.append(widget)
+        if callable(self.previous_callback):
+            self.previous_callback(widget)
+
+class TraceRecorder:
+    """
+    Records the widget function calls and the browser messages of a session, see the
+    module documentation.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.tracker = None
+        self.start_time = None
+        self.original_methods = None
+
+    def start(self):
+        self.events = []
+        self.start_time = time.perf_counter()
+        self.tracker = WidgetTracker()
+        self.tracker.install(self.record_call)
+
+        recorder = self
+        set_state, handle_custom_msg = Widget.set_state, Widget._handle_custom_msg
+        self.original_methods = (set_state, handle_custom_msg)
+
+        def recorded_set_state(widget, sync_data):
+            recorder.record_message(widget, "state", sync_data)
+            return set_state(widget, sync_data)
+
+        def recorded_custom_msg(widget, content, buffers):
+            recorder.record_message(widget, "custom", content)
+            return handle_custom_msg(widget, content, buffers)
+
+        # both are only called for messages coming from the browser
+        Widget.set_state = recorded_set_state
+        Widget._handle_custom_msg = recorded_custom_msg
+
+    def stop(self):
+        self.tracker.uninstall()
+        Widget.set_state, Widget._handle_custom_msg = self.original_methods
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    def record_call(self, name, args, kwargs):
+        self.events.append({
+            "type": "call", "time": self.elapsed(), "function": name,
+            "args": encode(list(args)), "kwargs": encode(kwargs),
+        })
+
+    def record_message(self, widget, kind, data):
+        index = self.tracker.ids.get(id(widget))
+        if index is None:
+            # created before recording started, it can't be found again on replay
+            return
+        self.events.append({
+            "type": kind, "time": self.elapsed(), "widget": index,
+            "label": widget_label(widget, self.tracker.functions[index]),
+            "data": data,
+        })
+
+    def trace(self):
+        return {"version": 1, "events": self.events}
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.trace(), f, indent=1)
+
+def load_trace(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def clear_caches():
+    """
+    Empties the caches the package keeps across calls. The loaded map, the imports
+    and the colormap registration, which a kernel only pays for once, are kept.
+    """
+    from . import cmb_utils, cosmology, functions, plot
+    cmb_utils.thumbnail_cache.clear()
+    for cache in (cmb_utils.map_statistics_cache, cmb_utils.map_pyramids, cmb_utils.map_splines,
+                  functions.spectral_grids, plot.array_support):
+        cache.clear()
+    for fn in (cmb_utils.matched_filter_kernel, cmb_utils.thumbnail_grid, cmb_utils.radial_bins,
+               cosmology.dimensionless_integrals):
+        fn.cache_clear()
+
+def reset_session(warm=False):
+    """
+    Forgets the state the widgets share, except for the loaded map, and empties the
+    caches unless `warm`.
+    """
+    from . import widgets
+    widgets.cmb_data.coords = []
+    widgets.cmb_data.mean_image = None
+    widgets.cmb_data.thumbnails = None
+    if not warm:
+        clear_caches()
+
+def replay(trace, callables=None, quiet=True, warm=False):
+    """
+    Replays a trace (see `TraceRecorder`) against the functions of `cmb.widgets`.
+
+    Parameters:
+    - trace: Trace dictionary, see `load_trace`.
+    - callables: Functions to pass where the trace refers to functions that can't be
+      imported, by their "module:name" reference.
+    - quiet: Whether to drop what the widgets display, which has nowhere to go
+      without a browser.
+    - warm: Whether to keep the caches filled by earlier calls, instead of starting
+      cold like a new kernel.
+
+    Returns:
+    - List of (label, latency in seconds, error) for every event of the trace, in
+      order. Widget function calls are labelled "function()", error is the repr of
+      the exception the event raised, or None.
+    """
+    from . import widgets
+
+    reset_session(warm)
+    tracker = WidgetTracker()
+    tracker.install()
+    latencies = []
+    output = io.StringIO() if quiet else sys.stdout
+    try:
+        with contextlib.redirect_stdout(output):
+            for event in trace["events"]:
+                if event["type"] == "call":
+                    label = f"{event['function']}()"
+                    fn = getattr(widgets, event["function"])
+                    args = decode(event["args"], callables), decode(event["kwargs"], callables)
+                    handle = lambda: fn(*args[0], **args[1])
+                else:
+                    index = event["widget"]
+                    if index >= len(tracker.widgets):
+                        raise ValueError(f"the trace refers to widget {index}, only {len(tracker.widgets)} were created")
+                    widget = tracker.widgets[index]
+                    label = widget_label(widget, tracker.functions[index])
+                    if label != event["label"]:
+                        raise ValueError(f"widget {index} is {label}, the trace expects {event['label']}")
+                    if event["type"] == "state":
+                        handle = lambda: widget.set_state(event["data"])
+                    else:
+                        handle = lambda: widget._handle_custom_msg(event["data"], [])
+
+                start = time.perf_counter()
+                error = None
+                try:
+                    handle()
+                except Exception as e:
+                    # in the notebook the error would be shown in the widget's output
+                    # and the session would go on
+                    error = repr(e)
+                latencies.append((label, time.perf_counter() - start, error))
+    finally:
+        tracker.uninstall()
+    return latencies
+
+def latency_report(latencies):
+    """
+    Summarizes replay latencies per widget.
+
+    Returns:
+    - List of dictionaries with the label, the number of events and of errors and the
+      p50, p95, p99 and max latencies (in milliseconds), in order of first appearance.
+    """
+    grouped = {}
+    errors = {}
+    for label, latency, error in latencies:
+        grouped.setdefault(label, []).append(latency * 1e3)
+        errors[label] = errors.get(label, 0) + (error is not None)
+    rows = []
+    for label, values in grouped.items():
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        rows.append({"label": label, "events": len(values), "errors": errors[label], "p50_ms": p50,
+                     "p95_ms": p95, "p99_ms": p99, "max_ms": max(values)})
+    return rows
+
+def print_report(rows):
+    width = max([len(row["label"]) for row in rows] + [5])
+    print(f"{'event':<{width}} {'count':>6} {'errors':>6} {'p50 [ms]':>9} {'p95 [ms]':>9} {'p99 [ms]':>9} {'max [ms]':>9}")
+    for row in rows:
+        print(f"{row['label']:<{width}} {row['events']:>6} {row['errors']:>6} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} "
+              f"{row['p99_ms']:>9.1f} {row['max_ms']:>9.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a widget trace and reports its latencies.")
+    parser.add_argument("trace")
+    parser.add_argument("--repeat", type=int, default=1, help="number of replays")
+    parser.add_argument("--synthetic", type=float, metavar="RES",
+                        help="replay on a synthetic map with pixels of RES degrees instead of the Planck map")
+    parser.add_argument("--warm", action="store_true",
+                        help="keep the caches between replays instead of starting each one cold")
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    import matplotlib
+    matplotlib.use("Agg")
+    from . import widgets, synthetic
+
+    if args.synthetic:
+        widgets.cmb_data.map = synthetic.synthetic_map(args.synthetic)
+
+    trace = load_trace(args.trace)
+    latencies = []
+    for _ in range(args.repeat):
+        latencies += replay(trace, warm=args.warm)
+
+    caches = "warm" if args.warm else "cold"
+    rows = latency_report(latencies)
+    print(f"caches: {caches}")
+    print_report(rows)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"caches": caches, "rows": rows}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
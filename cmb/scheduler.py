@@ -0,0 +1,143 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# thread pool shared by every LatestRunner, created on first use
+pool = None
+
+def thread_pool():
+    global pool
+    if pool is None:
+        pool = ThreadPoolExecutor(thread_name_prefix="cmb")
+    return pool
+
+def running_loop():
+    """ Returns the running asyncio event loop (e.g. ipykernel's), or None outside of one """
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+class UpdateScheduler:
+    """
+    Coalesces bursts of update requests into a single call of `fn`, made once no new
+    request arrived for `delay` seconds.
+
+    Requests are timed on the running asyncio event loop, which is the one ipykernel
+    dispatches widget events from. Without a running loop (plain scripts, tests) every
+    request calls `fn` right away, so behaviour stays deterministic.
+
+    `fn` may return False to signal it had nothing to redraw. The scheduler counts the
+    requests it received and the renders that actually happened; the difference is
+    the number of renders it suppressed.
+    """
+
+    def __init__(self, fn, delay=0.3):
+        self.fn = fn
+        self.delay = delay
+        self.handle = None
+        self.requests = 0
+        self.renders = 0
+
+    @property
+    def suppressed(self):
+        return self.requests - self.renders
+
+    def __call__(self, *args):
+        """ Requests an update, arguments (e.g. a trait change) are ignored """
+        self.requests += 1
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        loop = running_loop()
+        if loop is None:
+            self.run()
+        else:
+            self.handle = loop.call_later(self.delay, self.run)
+
+    def flush(self):
+        """ Runs a pending update now, or a new one if nothing is pending """
+        if self.handle is None:
+            self.requests += 1
+        else:
+            self.handle.cancel()
+            self.handle = None
+        self.run()
+
+    def run(self):
+        self.handle = None
+        if self.fn() is not False:
+            self.renders += 1
+
+class LatestRunner:
+    """
+    Runs the heavy part of a widget callback on a thread pool and draws its result
+    into an Output widget, keeping only the newest request ("latest wins").
+
+    `run(compute, draw)` calls `compute()` on a worker thread, then `draw(result)` back
+    on the event loop, inside `output` and after clearing it. When a newer request
+    arrives first, the older one is cancelled if it hasn't started yet, or its result
+    is discarded when it finishes, so a fast slider drag only draws its last position.
+    `compute` must not touch matplotlib, which is only safe on the main thread.
+
+    If a computation takes longer than `delay` seconds, `placeholder()` is drawn into
+    the output until the result arrives. Without a running event loop (plain scripts,
+    tests) both steps run right away, one after the other.
+    """
+
+    def __init__(self, output, placeholder=None, delay=0.2):
+        self.output = output
+        self.placeholder = placeholder
+        self.delay = delay
+        self.generation = 0
+        self.future = None
+        self.placeholder_handle = None
+        self.dropped = 0
+
+    def run(self, compute, draw):
+        self.generation += 1
+        generation = self.generation
+        self.supersede()
+
+        loop = running_loop()
+        if loop is None:
+            self.draw(draw, compute)
+            return
+
+        def finish(future):
+            # a newer request superseded this one while it was computing
+            if generation != self.generation:
+                return
+            self.future = None
+            self.clear_placeholder()
+            self.draw(draw, future.result)
+
+        if self.placeholder is not None:
+            self.placeholder_handle = loop.call_later(self.delay, self.show_placeholder)
+        self.future = thread_pool().submit(compute)
+        self.future.add_done_callback(lambda future: loop.call_soon_threadsafe(finish, future))
+
+    def supersede(self):
+        """ Drops the request in flight, if any """
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+            self.dropped += 1
+        self.clear_placeholder()
+
+    def draw(self, draw, result):
+        # errors raised by result() are shown in the output, like any other callback
+        with self.output:
+            self.output.clear_output(wait=True)
+            draw(result())
+
+    def show_placeholder(self):
+        self.placeholder_handle = None
+        with self.output:
+            self.output.clear_output(wait=True)
+            self.placeholder()
+
+    def clear_placeholder(self):
+        if self.placeholder_handle is not None:
+            self.placeholder_handle.cancel()
+            self.placeholder_handle = None
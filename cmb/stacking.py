@@ -0,0 +1,342 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import cmb_utils, lazy_import
+
+enmap = lazy_import("pixell.enmap")
+special = lazy_import("scipy.special")
+
+def as_coords(coords):
+    """ `coords` as an array of (ra, dec) pairs, raising a ValueError for anything else """
+    coords = np.asarray(coords, dtype=float)
+    if coords.size == 0:
+        return coords.reshape(0, 2)
+    if coords.shape[-1] != 2:
+        raise ValueError(f"coords must be (ra, dec) pairs, got an array of shape {coords.shape}")
+    return coords.reshape(-1, 2)
+
+class ThumbnailStack:
+    """
+    Stack of thumbnails extracted from a map around a list of coordinates.
+
+    Besides the thumbnails, the stack keeps their cumulative sum and Welford's running
+    sum of squared deviations, so the mean and variance of any leading subset of the
+    stack cost a single subtraction and division, no matter how many thumbnails it holds.
+    """
+
+    def __init__(self, imap, coords=()):
+        self.imap = imap
+        self.coords = np.empty((0, 2))
+        self.thumbnails = None
+        self.wcs = None
+        # cumsum[n] is the sum of the first n thumbnails, cumsum[0] is all zeros
+        self.cumsum = None
+        # m2[n] is the sum of squared deviations from the mean of the first n thumbnails
+        self.m2 = None
+
+        if len(coords) > 0:
+            self.append(coords)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def append(self, coords):
+        """
+        Extracts the thumbnails around `coords` ((ra, dec) in degrees) and adds them to
+        the stack.
+        """
+        coords = as_coords(coords)
+        if len(coords) == 0:
+            return
+        thumbnails = cmb_utils.extract_thumbnails(self.imap, coords)
+        new = np.asarray(thumbnails, dtype=float)
+
+        if self.thumbnails is None:
+            self.wcs = thumbnails.wcs
+            self.thumbnails = new
+            self.cumsum = np.zeros((1,) + new.shape[1:])
+            self.m2 = np.zeros((1,) + new.shape[1:])
+        else:
+            self.thumbnails = np.concatenate([self.thumbnails, new])
+
+        n = len(self.coords)
+        count = np.arange(n + 1, n + len(new) + 1).reshape(-1, 1, 1)
+        cumsum = self.cumsum[-1] + np.cumsum(new, axis=0)
+        mean = cumsum / count
+        # Welford's update, m2_k = m2_(k-1) + (x_k - mean_(k-1)) * (x_k - mean_k),
+        # evaluated for all the new thumbnails at once through a cumulative sum;
+        # the first thumbnail has no previous mean and contributes no deviation
+        first = new[:1] if n == 0 else self.cumsum[-1:] / n
+        previous_mean = np.concatenate([first, mean[:-1]])
+        m2 = self.m2[-1] + np.cumsum((new - previous_mean) * (new - mean), axis=0)
+
+        self.cumsum = np.concatenate([self.cumsum, cumsum])
+        self.m2 = np.concatenate([self.m2, m2])
+        self.coords = np.concatenate([self.coords, coords])
+
+    def truncate(self, n):
+        """ Keeps only the first `n` thumbnails """
+        if n >= len(self):
+            return
+        self.coords = self.coords[:n]
+        self.thumbnails = self.thumbnails[:n]
+        self.cumsum = self.cumsum[:n + 1]
+        self.m2 = self.m2[:n + 1]
+
+    def update(self, coords):
+        """
+        Makes the stack hold the thumbnails around `coords` ((ra, dec) in degrees),
+        keeping the leading thumbnails whose coordinates didn't change and extracting
+        the others again.
+        """
+        coords = as_coords(coords)
+        n = min(len(coords), len(self))
+        same = np.all(self.coords[:n] == coords[:n], axis=1)
+        prefix = n if same.all() else int(np.argmin(same))
+        self.truncate(prefix)
+        self.append(coords[prefix:])
+
+    def mean(self, n=None):
+        """
+        Mean of the first `n` thumbnails (all of them by default).
+        """
+        n = self.count(n)
+        return enmap.ndmap(self.cumsum[n] / n, self.wcs)
+
+    def variance(self, n=None, ddof=0):
+        """
+        Per-pixel variance of the first `n` thumbnails (all of them by default).
+        """
+        n = self.count(n)
+        return enmap.ndmap(self.m2[n] / (n - ddof), self.wcs)
+
+    def count(self, n=None):
+        if len(self) == 0:
+            raise ValueError("the stack is empty")
+        if n is None:
+            return len(self)
+        return int(np.clip(n, 1, len(self)))
+
+    def stack(self, method="mean", n=None, weights=None):
+        """
+        Stack of the first `n` thumbnails (all of them by default), see `stack`.
+        """
+        n = self.count(n)
+        if method == "mean":
+            return self.mean(n)
+        if weights is not None:
+            weights = np.asarray(weights)[:n]
+        return stack(enmap.ndmap(self.thumbnails[:n], self.wcs), method, weights)
+
+    def subset(self, n=None):
+        """ The first `n` thumbnails (all of them by default) as an enmap """
+        return enmap.ndmap(self.thumbnails[:self.count(n)], self.wcs)
+
+def inverse_variance_weights(thumbnails, inner=0.5):
+    """
+    Weight of each thumbnail, the inverse of its noise variance, so noisy thumbnails
+    count less in the stack.
+
+    The variance is measured on the pixels more than `inner` degrees from the centre,
+    outside the hot spot. The variance of the whole thumbnail would be dominated by
+    the hot spot itself and weight down the brightest ones. Without a noise map, the
+    annulus still holds the CMB around the hot spot, which is statistically the same
+    everywhere, so the weights follow the noise and foregrounds of each position.
+    """
+    outside = np.rad2deg(thumbnails.modrmap()) > inner
+    values = np.asarray(thumbnails, dtype=float)[:, outside]
+    return 1 / np.var(values, axis=1)
+
+def weighted_mean(thumbnails, weights):
+    """ Per-pixel mean of the thumbnails, weighting each one by `weights` """
+    weights = np.asarray(weights, dtype=float)
+    return np.tensordot(weights, np.asarray(thumbnails, dtype=float), axes=1) / weights.sum()
+
+def clipped_mean(thumbnails, n_sigma=3, iterations=5):
+    """
+    Per-pixel mean of the thumbnails, leaving out the values more than `n_sigma`
+    standard deviations away from the mean of their pixel, iterated until nothing
+    more is clipped or after `iterations` rounds.
+    """
+    values = np.asarray(thumbnails, dtype=float)
+    keep = np.ones(values.shape, dtype=bool)
+    for _ in range(iterations):
+        count = np.maximum(keep.sum(axis=0), 1)
+        mean = np.sum(values, axis=0, where=keep) / count
+        std = np.sqrt(np.sum((values - mean)**2, axis=0, where=keep) / count)
+        new_keep = np.abs(values - mean) <= n_sigma * std
+        if np.array_equal(new_keep, keep):
+            break
+        keep = new_keep
+    return np.sum(values, axis=0, where=keep) / np.maximum(keep.sum(axis=0), 1)
+
+def stack(thumbnails, method="mean", weights=None):
+    """
+    Stacks thumbnails pixel by pixel.
+
+    Parameters:
+    - thumbnails: Enmap of shape (n, ny, nx).
+    - method: One of "mean", "weighted" (inverse variance weights unless `weights` is
+      given), "clipped" (sigma-clipped mean) or "median".
+    - weights: Weight of each thumbnail for the "weighted" method.
+
+    Returns:
+    - The stacked thumbnail, an enmap of shape (ny, nx).
+    """
+    if method == "mean":
+        image = np.mean(thumbnails, axis=0)
+    elif method == "weighted":
+        if weights is None:
+            weights = inverse_variance_weights(thumbnails)
+        image = weighted_mean(thumbnails, weights)
+    elif method == "clipped":
+        image = clipped_mean(thumbnails)
+    elif method == "median":
+        image = np.median(thumbnails, axis=0)
+    else:
+        raise ValueError(f"unknown method {method!r}")
+    return enmap.ndmap(np.asarray(image), thumbnails.wcs)
+
+def hotspot_size(radius, profiles, threshold=0.3):
+    """
+    Angular size of the hot spot of each profile: the radius at which the profile
+    first drops to `threshold` times its peak, interpolated linearly between the two
+    bins around the crossing, so the size varies continuously with the profile. NaN
+    if it never drops that low.
+
+    Parameters:
+    - radius: Bin centers of the profiles (in degrees).
+    - profiles: Array of shape (..., nbins).
+    """
+    profiles = np.asarray(profiles, dtype=float)
+    radius = np.asarray(radius, dtype=float)
+    level = threshold * np.nanmax(profiles, axis=-1, keepdims=True)
+    below = profiles <= level
+    after = np.argmax(below, axis=-1)[..., None]
+    before = np.maximum(after - 1, 0)
+
+    p0 = np.take_along_axis(profiles, before, axis=-1)
+    p1 = np.take_along_axis(profiles, after, axis=-1)
+    fraction = np.divide(p0 - level, p0 - p1, out=np.zeros_like(p0), where=p0 != p1)
+    size = radius[before] + np.clip(fraction, 0, 1) * (radius[after] - radius[before])
+    return np.where(below.any(axis=-1), size[..., 0], np.nan)
+
+def resample_counts(n, n_resamples, rng):
+    """
+    Bootstrap resamples of `n` thumbnails as a (n_resamples, n) matrix counting how
+    many times each thumbnail is drawn, so a resampled sum is a matrix product.
+    """
+    draws = rng.integers(0, n, size=(n_resamples, n))
+    offsets = n * np.arange(n_resamples)[:, None]
+    return np.bincount((draws + offsets).ravel(), minlength=n * n_resamples).reshape(n_resamples, n)
+
+def bootstrap_chunk(profiles, weights, n_resamples, seed):
+    """ Mean profiles of `n_resamples` bootstrap resamples of `profiles` """
+    counts = resample_counts(len(profiles), n_resamples, np.random.default_rng(seed))
+    counts = counts * weights
+    return counts @ profiles / counts.sum(axis=1, keepdims=True)
+
+def bootstrap_profiles(profiles, weights=None, n_resamples=1000, seed=None, processes=None,
+                       chunk_size=250):
+    """
+    Mean profiles of bootstrap resamples of a stack of profiles.
+
+    Each resample is a row of a count matrix, so a chunk of resamples is a single
+    matrix product instead of a Python loop. Chunks are spread over a pool of
+    `processes` processes when given more than one. Every chunk gets its own seed
+    derived from `seed`, so the result doesn't depend on the number of processes.
+
+    Parameters:
+    - profiles: Array of shape (n, nbins), e.g. from `cmb_utils.radial_profiles`.
+    - weights: Weight of each profile, all equal by default.
+    - n_resamples: Number of bootstrap resamples.
+    - seed: Seed of the random draws.
+    - processes: Number of worker processes, by default everything runs here.
+    - chunk_size: Number of resamples drawn at once.
+
+    Returns:
+    - Array of shape (n_resamples, nbins).
+    """
+    profiles = np.asarray(profiles, dtype=float)
+    weights = np.ones(len(profiles)) if weights is None else np.asarray(weights, dtype=float)
+    sizes = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = [(profiles, weights, size, chunk_seed) for size, chunk_seed in zip(sizes, seeds)]
+
+    if processes is not None and processes > 1:
+        with ProcessPoolExecutor(processes) as pool:
+            chunks = list(pool.map(bootstrap_chunk, *zip(*args)))
+    else:
+        chunks = [bootstrap_chunk(*chunk_args) for chunk_args in args]
+    return np.concatenate(chunks)
+
+def jackknife_profiles(profiles, weights=None):
+    """
+    Leave-one-out mean profiles of a stack of profiles, all computed at once from the
+    total weighted sum.
+
+    Returns:
+    - Array of shape (n, nbins), row i being the mean without profile i.
+    """
+    profiles = np.asarray(profiles, dtype=float)
+    weights = np.ones(len(profiles)) if weights is None else np.asarray(weights, dtype=float)
+    weighted = weights[:, None] * profiles
+    return (weighted.sum(axis=0) - weighted) / (weights.sum() - weights)[:, None]
+
+def hotspot_size_interval(thumbnails, threshold=0.3, confidence=0.68, method="bootstrap",
+                          weights=None, n_resamples=1000, seed=None, processes=None):
+    """
+    Angular size of the stacked hot spot (see `hotspot_size`) with a confidence
+    interval from resampling the stack. The resampling works on the radial profile
+    of each thumbnail, which is linear in the thumbnails, so the profile of a
+    resampled stack is the resampled mean of the profiles.
+
+    Parameters:
+    - thumbnails: Enmap of shape (n, ny, nx).
+    - threshold: Fraction of the peak that defines the edge of the hot spot.
+    - confidence: Probability covered by the interval.
+    - method: "bootstrap" (percentile interval) or "jackknife" (normal interval
+      from the jackknife standard error).
+    - weights: Weight of each thumbnail, all equal by default.
+    - n_resamples, seed, processes: See `bootstrap_profiles`.
+
+    Returns:
+    - Tuple with the size of the whole stack and the low and high ends of the interval
+      (in degrees).
+    """
+    radius, profiles = cmb_utils.radial_profiles(thumbnails)
+    w = np.ones(len(profiles)) if weights is None else np.asarray(weights, dtype=float)
+    size = float(hotspot_size(radius, w @ profiles / w.sum(), threshold))
+
+    if method == "bootstrap":
+        resampled = bootstrap_profiles(profiles, weights, n_resamples, seed, processes)
+        sizes = hotspot_size(radius, resampled, threshold)
+        tail = (1 - confidence) / 2
+        low, high = np.nanquantile(sizes, [tail, 1 - tail]).tolist()
+    elif method == "jackknife":
+        sizes = hotspot_size(radius, jackknife_profiles(profiles, weights), threshold)
+        n = len(sizes)
+        error = np.sqrt((n - 1) / n * np.nansum((sizes - np.nanmean(sizes))**2))
+        z = np.sqrt(2) * special.erfinv(confidence)
+        low, high = size - z * error, size + z * error
+    else:
+        raise ValueError(f"unknown method {method!r}")
+    return size, low, high
+
+def random_coords(n, seed=None, max_dec=60):
+    """
+    `n` random (ra, dec) positions in degrees, uniform on the sphere within `max_dec`
+    degrees of the equator.
+    """
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(-180, 180, n)
+    dec = np.rad2deg(np.arcsin(rng.uniform(-1, 1, n) * np.sin(np.deg2rad(max_dec))))
+    return np.column_stack([ra, dec])
+
+def null_stack(imap, n, seed=None, max_dec=60):
+    """
+    Stack of `n` thumbnails at random positions, to compare a hot spot stack with
+    what stacking the same number of arbitrary positions gives.
+    """
+    return ThumbnailStack(imap, random_coords(n, seed, max_dec))
@@ -0,0 +1,211 @@
+"""
+Synthetic CMB-like maps on pixell CAR geometries, for testing and benchmarking the
+map pipeline at any size without downloading Planck or ACT products.
+
+The temperature is a Gaussian random field with a given angular power spectrum (an
+approximate CMB spectrum by default), optionally with point sources and white noise
+added. Maps are generated in strips of rows, so a map of any size can be written to
+disk with bounded memory, and everything is derived from a seed: the same seed always
+gives the same map, however it is generated.
+"""
+import numpy as np
+
+from . import lazy_import
+
+fits = lazy_import("astropy.io.fits")
+enmap = lazy_import("pixell.enmap")
+fft = lazy_import("scipy.fft")
+
+# amplitude, center and width of the acoustic peaks of the default spectrum, D_l in uK^2
+ACOUSTIC_PEAKS = [(5700, 220, 90), (2600, 540, 110), (2500, 810, 120), (1200, 1120, 130), (800, 1430, 140)]
+
+def cmb_power_spectrum(lmax=20000):
+    """
+    Approximate CMB temperature power spectrum: a Sachs-Wolfe plateau and five
+    acoustic peaks, damped at small scales. Good enough for realistic looking maps,
+    not for science.
+
+    Returns:
+    - Tuple with the multipoles 0..lmax and C_l (in K^2).
+    """
+    ell = np.arange(lmax + 1, dtype=float)
+    dl = 1000 + sum(amplitude * np.exp(-0.5 * ((ell - center) / width)**2)
+                    for amplitude, center, width in ACOUSTIC_PEAKS)
+    dl *= np.exp(-(ell / 1800)**2)
+    cl = np.zeros_like(ell)
+    cl[2:] = 2 * np.pi * dl[2:] / (ell[2:] * (ell[2:] + 1)) * 1e-12
+    return ell, cl
+
+def map_geometry(res, box=None):
+    """
+    CAR geometry with pixels of `res` degrees, covering the full sky or only `box`
+    ([[dec_from, ra_from], [dec_to, ra_to]] in degrees).
+    """
+    if box is None:
+        return enmap.fullsky_geometry(res=np.deg2rad(res))
+    return enmap.geometry(pos=np.deg2rad(box), res=np.deg2rad(res), proj="car")
+
+def source_catalog(shape, wcs, n, amplitude=3e-4, seed=0):
+    """
+    `n` point sources uniformly spread over the pixels of the map, with exponentially
+    distributed amplitudes of mean `amplitude` (in K).
+
+    Returns:
+    - Catalog of shape (n, 5) with the y and x pixel coordinates, the dec and ra (in
+      degrees) and the amplitude of each source.
+    """
+    rng = np.random.default_rng([seed, 2])
+    y = rng.uniform(0, shape[-2], n)
+    x = rng.uniform(0, shape[-1], n)
+    dec, ra = np.rad2deg(enmap.pix2sky(shape, wcs, [y, x], safe=False))
+    return np.column_stack([y, x, dec, ra, rng.exponential(amplitude, n)])
+
+def add_sources(rows, y0, catalog, sigma):
+    """
+    Adds Gaussian sources of `sigma` pixels from `catalog` (see `source_catalog`) to
+    `rows`, the map rows starting at `y0`, wrapping around in x.
+    """
+    height, width = rows.shape
+    reach = int(np.ceil(4 * sigma))
+    near = (catalog[:, 0] > y0 - reach) & (catalog[:, 0] < y0 + height + reach)
+    for y, x, _, _, amplitude in catalog[near]:
+        ys = np.arange(max(int(y) - reach, y0), min(int(y) + reach + 2, y0 + height))
+        xs = np.arange(int(x) - reach, int(x) + reach + 2)
+        stamp = np.exp(-0.5 * (((ys[:, None] - y) / sigma)**2 + ((xs[None, :] - x) / sigma)**2))
+        rows[np.ix_(ys - y0, xs % width)] += amplitude * stamp
+
+def field_filter(height, width, pixel_y, pixel_x, spectrum):
+    """
+    Fourier space amplitude turning unit white noise into a field with the power
+    spectrum `spectrum` ((ell, C_l) tuple), for strips of `height` x `width` pixels
+    of the given sizes (in radians), in the flat sky approximation.
+    """
+    ly = 2 * np.pi * fft.fftfreq(height, pixel_y)
+    lx = 2 * np.pi * fft.rfftfreq(width, pixel_x)
+    ell = np.sqrt(ly[:, None]**2 + lx[None, :]**2)
+    ells, cl = spectrum
+    return np.sqrt(np.interp(ell, ells, cl, right=0) / (pixel_y * pixel_x))
+
+def generate_rows(shape, wcs, seed=0, spectrum=None, sources=0, source_fwhm=0.5,
+                  source_amplitude=3e-4, noise=0, strip_rows=256, overlap=32, workers=-1):
+    """
+    Generates a synthetic temperature map strip by strip.
+
+    Each strip of `strip_rows` rows is an independent FFT realization of the field,
+    `overlap` rows taller on each side. Neighbouring strips are crossfaded over their
+    2 * `overlap` shared rows with cos/sin weights, which keeps the variance of the
+    field constant across the seams. In x the field is periodic, as it should be on
+    a full sky map. Strip i is drawn from the seed (seed, 0, i), so the result only
+    depends on `seed`, `strip_rows` and `overlap`.
+
+    Parameters:
+    - shape, wcs: Geometry of the map, see `map_geometry`.
+    - seed: Seed of the realization.
+    - spectrum: (ell, C_l) tuple with C_l in K^2, defaults to `cmb_power_spectrum`.
+    - sources: Number of point sources, see `source_catalog`.
+    - source_fwhm: Width of the sources (in degrees).
+    - source_amplitude: Mean amplitude of the sources (in K).
+    - noise: White noise level (in K arcmin).
+    - strip_rows: Number of rows generated at once, which bounds the memory used.
+    - overlap: Number of rows crossfaded on each side of a seam.
+    - workers: Threads of the FFTs, all CPUs by default.
+
+    Yields:
+    - Tuples with the index of the first row and the float32 rows, in order.
+    """
+    ny, nx = shape[-2:]
+    spectrum = spectrum or cmb_power_spectrum()
+    pixel_y, pixel_x = np.deg2rad(np.abs(wcs.wcs.cdelt[::-1]))
+    overlap = min(overlap, strip_rows // 2)
+    height = strip_rows + 2 * overlap
+    amplitude = field_filter(height, nx, pixel_y, pixel_x, spectrum)
+    catalog = source_catalog(shape, wcs, sources, source_amplitude, seed)
+    sigma = source_fwhm / np.abs(wcs.wcs.cdelt[1]) / np.sqrt(8 * np.log(2))
+    noise_rms = noise / (60 * np.sqrt(np.abs(wcs.wcs.cdelt[0] * wcs.wcs.cdelt[1])))
+
+    def strip(i):
+        white = np.random.default_rng([seed, 0, i]).standard_normal((height, nx))
+        return fft.irfft2(fft.rfft2(white, workers=workers) * amplitude, s=(height, nx), workers=workers)
+
+    # cos/sin crossfade over the 2 * overlap rows shared by two strips
+    angle = (np.arange(2 * overlap) + 0.5) / (2 * overlap) * np.pi / 2
+    fade_out, fade_in = np.cos(angle)[:, None], np.sin(angle)[:, None]
+
+    # strip i covers rows i * strip_rows - overlap to (i + 1) * strip_rows + overlap
+    previous = strip(0)
+    for i in range(-(-ny // strip_rows)):
+        y0 = i * strip_rows
+        y1 = min(y0 + strip_rows, ny)
+        # rows y0 + overlap to y1 - overlap are only in this strip, the overlap rows
+        # before them were blended with the previous strip and the ones after with the next
+        start = 0 if i == 0 else overlap
+        if y1 < ny:
+            following = strip(i + 1)
+            seam = previous[-2 * overlap:] * fade_out + following[:2 * overlap] * fade_in
+            rows = np.concatenate([previous[overlap + start:height - 2 * overlap], seam[:overlap]])
+        else:
+            following = None
+            rows = previous[overlap + start:overlap + y1 - y0]
+        if i > 0:
+            rows = np.concatenate([head, rows])[:y1 - y0]
+
+        if noise:
+            rows = rows + np.random.default_rng([seed, 1, i]).normal(0, noise_rms, rows.shape)
+        if sources:
+            add_sources(rows, y0, catalog, sigma)
+        yield y0, rows.astype(np.float32)
+
+        if following is not None:
+            head = seam[overlap:]
+            previous = following
+
+def synthetic_map(res, box=None, seed=0, **kwargs):
+    """
+    Synthetic temperature map with pixels of `res` degrees, on the full sky or only
+    `box`, assembled in memory. See `generate_rows` for the other parameters.
+
+    Returns:
+    - Float32 enmap.
+    """
+    shape, wcs = map_geometry(res, box)
+    imap = enmap.zeros(shape, wcs, dtype=np.float32)
+    for y0, rows in generate_rows(shape, wcs, seed, **kwargs):
+        imap[y0:y0 + len(rows)] = rows
+    return imap
+
+def write_synthetic_map(filename, res, box=None, seed=0, components=3, **kwargs):
+    """
+    Writes a synthetic map to a FITS file in the layout of the Planck maps that
+    `cmb_utils.load_cmb_map` reads: a float32 primary HDU of shape (components, ny, nx)
+    whose first component is the temperature. The other components (Q and U) are
+    written as zeros. The file is streamed strip by strip, so it can be far larger
+    than the memory. See `generate_rows` for the other parameters.
+
+    Returns:
+    - The source catalog (see `source_catalog`) of the map.
+    """
+    shape, wcs = map_geometry(res, box)
+    ny, nx = shape
+
+    header = fits.Header()
+    header["SIMPLE"] = True
+    header["BITPIX"] = -32
+    header["NAXIS"] = 3 if components > 1 else 2
+    header["NAXIS1"] = nx
+    header["NAXIS2"] = ny
+    if components > 1:
+        header["NAXIS3"] = components
+    header.extend(wcs.to_header(relax=True))
+
+    hdu = fits.StreamingHDU(filename, header)
+    try:
+        for _, rows in generate_rows(shape, wcs, seed, **kwargs):
+            hdu.write(rows)
+        zeros = np.zeros((min(ny, 1024), nx), np.float32)
+        for _ in range(components - 1):
+            for y0 in range(0, ny, len(zeros)):
+                hdu.write(zeros[:ny - y0])
+    finally:
+        hdu.close()
+
+    return source_catalog(shape, wcs, kwargs.get("sources", 0), kwargs.get("source_amplitude", 3e-4), seed)
@@ -1,29 +1,47 @@
 import os
 import uuid
+import threading
 from dataclasses import dataclass
 from typing import List
 
 import numpy as np
-from ipywidgets import interact, Output, Label, VBox, HBox, widgets
-from IPython.display import display, IFrame
 
 from .i18n import I18N
 i18n = I18N()
 
-from . import plot, const, cmb_utils
+from . import plot, const, cmb_utils, stacking, scheduler, profiling, lazy_import, lazy_function
+
+widgets = lazy_import("ipywidgets.widgets")
+display = lazy_function("IPython.display", "display")
+IFrame = lazy_function("IPython.display", "IFrame")
 
 @dataclass
 class CMBStoringData:
-    map: object
+    filename: str
     coords: List[List[float]]
     mean_image: object
+    thumbnails: object
 
-    def __init__(self):
-        dir = os.path.dirname(os.path.abspath(__file__))
-        fits=f'{dir}/../data/COM_CMB_IQU-commander_1024_R2.02_dg16_car.fits'
-        self.map = cmb_utils.load_cmb_map(fits)
+    def __init__(self, filename=None):
+        if filename is None:
+            dir = os.path.dirname(os.path.abspath(__file__))
+            filename = f'{dir}/../data/COM_CMB_IQU-commander_1024_R2.02_dg16_car.fits'
+        self.filename = filename
         self.coords = []
         self.mean_image = None
+        self.thumbnails = None
+        self._map = None
+
+    @property
+    def map(self):
+        """Temperature map, loaded from disk the first time a widget needs it."""
+        if self._map is None:
+            self._map = cmb_utils.load_cmb_map(self.filename)
+        return self._map
+
+    @map.setter
+    def map(self, imap):
+        self._map = imap
 
 # global instance to store the data accross the widgets
 cmb_data = CMBStoringData()
@@ -38,15 +56,20 @@ def peak_wavelength(bb_student_fn, wl_student_fn, wavelengths=const.wavelengths)
     - wavelengths: Array of wavelengths (in meters) to plot.
     """
     
+    output = widgets.Output()
+    live_plot = plot.PeakWavelengthPlot(output)
+
+    @profiling.profiled
     def update(temp, ref):
         ref_name, ref_temp = ref
-        plot.peak_wavelength(wavelengths, ref_name, ref_temp, temp, bb_student_fn, wl_student_fn)
+        live_plot.draw(wavelengths, ref_name, ref_temp, temp, bb_student_fn, wl_student_fn)
 
     temperature = temperature_slider()
     reference = reference_dropdown()
     set_widget_styles([temperature, reference])
     
-    interact(update, temp=temperature, ref=reference)
+    widgets.interact(update, temp=temperature, ref=reference)
+    display(output)
 
 def blackbody_radiation(student_fn, wavelengths=const.wavelengths):
     """
@@ -57,23 +80,41 @@ def blackbody_radiation(student_fn, wavelengths=const.wavelengths):
     - wavelengths: Array of wavelengths (in meters) to plot.
     """
 
-    output = Output()
+    output = widgets.Output()
+    live_plot = plot.BlackbodyPlot(output)
     
+    @profiling.profiled
     def update(temp, ref):
         ref_name, ref_temp = ref
-        with output:
-            output.clear_output(wait=True)
-            plot.blackbody_radiation(wavelengths, ref_name, ref_temp, temp, student_fn)
+        live_plot.draw(wavelengths, ref_name, ref_temp, temp, student_fn)
         
     temperature = temperature_slider()
     reference = reference_dropdown()
     set_widget_styles([temperature, reference])
     
-    interact(update, temp=temperature, ref=reference)
+    widgets.interact(update, temp=temperature, ref=reference)
     display(output)
 
+def blackbody_heatmap(wavelengths=const.wavelengths):
+    """
+    Creates an interactive heatmap of black body radiation across temperatures and
+    wavelengths, with a slider to highlight a temperature.
+    
+    Parameters:
+    - wavelengths: Array of wavelengths (in meters) to plot.
+    """
+
+    @profiling.profiled
+    def update(temp):
+        plot.blackbody_heatmap(wavelengths, temp)
+
+    temperature = temperature_slider()
+    set_widget_styles([temperature])
+
+    widgets.interact(update, temp=temperature)
+
 def redshift():
-    output = Output()
+    output = widgets.Output()
 
     slider = widgets.FloatSlider(
         value=0,
@@ -85,7 +126,7 @@ def redshift():
         tooltip=i18n.gettext("velocity_slider_tooltip")
     )
 
-    velocity_label = Label()
+    velocity_label = widgets.Label()
 
     def update_label(change):
         velocity = change['new']
@@ -97,23 +138,25 @@ def redshift():
             velocity_power_ten = "{:.2f} x 10^{}".format(base, exponent)
         velocity_label.value = f"{velocity_power_ten} m/s"
 
+    @profiling.profiled
     def update_plot(change):
-        plot.redshift_visualization(change['new'], output)
+        live_plot.draw(change['new'])
 
     slider.observe(update_label, names='value')
 
     update_label({'new': slider.value})
 
-    output = Output()
+    output = widgets.Output()
+    live_plot = plot.RedshiftPlot(output)
 
-    ui = VBox([HBox([slider, velocity_label]), output])
+    ui = widgets.VBox([widgets.HBox([slider, velocity_label]), output])
 
     slider.observe(update_plot, names='value')
     set_widget_styles([slider, velocity_label])
 
     display(ui)
 
-    plot.redshift_visualization(slider.value, output)
+    live_plot.draw(slider.value)
 
 def cobe_fit(bb_student_fn, temperature=300):
 
@@ -162,9 +205,11 @@ def cobe_fit(bb_student_fn, temperature=300):
     display(reference_selector, temperature_slider)
 
     output = widgets.Output()
+    live_plot = plot.CobeFitPlot(output)
 
+    @profiling.profiled
     def update_plot(*args):
-        plot.cobe_curve_fit(temperature_slider.value, bb_student_fn, output)
+        live_plot.draw(temperature_slider.value, bb_student_fn)
 
     # Link the display function to changes in the temperature slider
     temperature_slider.observe(update_plot, names='value')
@@ -182,12 +227,21 @@ def cmb_std_dev():
         indent=False
     )
 
+    output = widgets.Output()
+    runner = background_runner(output)
+
+    @profiling.profiled
     def update_plot(guidelines):
         map = cmb_data.map
         if map is not None:
-            plot.cmb_std_dev(map, guidelines)
+            # the statistics are computed for the first draw of each map only
+            runner.run(
+                lambda: cmb_utils.map_statistics(map),
+                lambda stats: plot.cmb_std_dev(map, guidelines, stats)
+            )
 
-    interact(update_plot, guidelines=guidelines)
+    widgets.interact(update_plot, guidelines=guidelines)
+    display(output)
 
 def reference_dropdown():
     return widgets.Dropdown(
@@ -207,8 +261,8 @@ def temperature_slider(value=5778):
         tooltip=i18n.gettext("temperature_slider_tooltip_bb")
     )
 
-def cmb_planck_map():
-    plot.planck_map(cmb_data.map)
+def cmb_planck_map(box=None):
+    plot.planck_map(cmb_data.map, box)
 
 def cmb_map_iframe(height=400):
     display(IFrame(const.cmb_map_url, width='100%', height=f'{height}px'))
@@ -353,11 +407,16 @@ def coordinate_inputs(initial_coords=const.cmb_thumbnails_coords):
     if len(cmb_data.coords) == 0:
         cmb_data.coords = initial_coords
 
-    output = Output()
+    output = widgets.Output()
+    runner = background_runner(output)
     container = widgets.VBox()
     coord_widgets = []
+    # coordinates of the latest update and the thumbnails currently drawn
+    requested = []
+    rendered = []
 
-    def update(change=None):
+    @profiling.profiled
+    def render():
         coords = []
         for i, (lat_input, long_input, id) in enumerate(coord_widgets):
             lat, long = lat_input.value, long_input.value
@@ -366,16 +425,37 @@ def coordinate_inputs(initial_coords=const.cmb_thumbnails_coords):
         
         cmb_data.coords = coords
 
-        thumbnails = cmb_utils.extract_thumbnails(cmb_data.map, coords)
-        with output:
-            output.clear_output(wait=True)
-            cmb_utils.plot_thumbnails(thumbnails, figsize=(10, 6))
+        if requested and coords == requested[0]:
+            return False
+        requested[:] = [coords]
+
+        previous = dict(rendered)
+        changed = [coord for coord in coords if coord not in previous]
+
+        @profiling.profiled
+        def compute():
+            # only extract the rows that changed, the others keep their thumbnail
+            thumbnails = dict(previous)
+            if changed:
+                thumbnails.update(zip(changed, cmb_utils.extract_thumbnails(cmb_data.map, changed)))
+            return [(coord, thumbnails[coord]) for coord in coords]
+
+        @profiling.profiled
+        def draw(thumbnails):
+            rendered[:] = thumbnails
+            cmb_utils.plot_thumbnails([thumbnail for _, thumbnail in thumbnails], figsize=(10, 6))
+
+        runner.run(compute, draw)
+
+    # typing a coordinate changes the value once per keystroke, wait for a
+    # pause before redrawing
+    update = scheduler.UpdateScheduler(render)
+    container.scheduler = update
 
     def on_remove_button_clicked(change):
         for child in container.children:
             if child.id == change.id:
                 container.children = tuple([child for child in container.children if child.id != change.id])
-                update()
         for lat_input, long_input, id in coord_widgets:
             if id == change.id:
                 coord_widgets.remove((lat_input, long_input, id))
@@ -428,12 +508,13 @@ def coordinate_inputs(initial_coords=const.cmb_thumbnails_coords):
 
     add_button.on_click(on_add_button_clicked)
     
-    update()
+    update.flush()
     display(container, add_button, output)
 
 def cmb_thumbnails_averaging(all=False):
 
-    output = Output()
+    output = widgets.Output()
+    runner = background_runner(output)
 
     value = len(cmb_data.coords) if all else 1
 
@@ -448,20 +529,47 @@ def cmb_thumbnails_averaging(all=False):
         tooltip=i18n.gettext("thumbnails_slider_tooltip")
     )
 
-    def update(amount):
-        thumbnails = cmb_utils.extract_thumbnails(cmb_data.map, cmb_data.coords[0:amount])
-        mean_thumbnail = np.mean(thumbnails, axis=0)
-        with output:
-            output.clear_output(wait=True)
-            plot.view_map_pixel(mean_thumbnail)
+    # extract every thumbnail once, moving the slider only reads the running sums
+    stack = None
+    stack_lock = threading.Lock()
+
+    @profiling.profiled
+    def compute(amount):
+        nonlocal stack
+        with stack_lock:
+            if stack is None or stack.imap is not cmb_data.map:
+                stack = stacking.ThumbnailStack(cmb_data.map)
+            # follow the coordinates edited in coordinate_inputs since the last update,
+            # only the ones that changed are extracted
+            stack.update(cmb_data.coords)
+            return stack.mean(amount), stack.subset(amount), len(stack)
+
+    def publish(result):
+        mean_thumbnail, thumbnails, count = result
+        slider.max = count
         cmb_data.mean_image = mean_thumbnail
+        cmb_data.thumbnails = thumbnails
+
+    @profiling.profiled
+    def draw(result):
+        publish(result)
+        plot.view_map_pixel(result[0])
+
+    @profiling.profiled
+    def update(amount):
+        runner.run(lambda: compute(amount), draw)
+
+    # build the stack and publish the first mean before returning, the hot-spot
+    # profile cells that follow read it right away (e.g. on "Run All"); later
+    # slider moves only read the running sums
+    publish(compute(slider.value))
 
     set_widget_styles([slider]) 
 
-    interact(update, amount=slider)
+    widgets.interact(update, amount=slider)
     display(output)
 
-def averaged_hotspot_profile(plot_fn, img_fn, value):
+def averaged_hotspot_profile(plot_fn, img_fn, value, interval=False):
 
     slider = widgets.IntSlider(
         value=value,
@@ -476,13 +584,34 @@ def averaged_hotspot_profile(plot_fn, img_fn, value):
 
     set_widget_styles([slider, percent])
 
-    graph = Output()
-    img = Output()
+    graph = widgets.Output()
+    img = widgets.Output()
+    runner = background_runner(graph)
 
     def on_change(change):
         percent.value = f'{change["new"]}%'
         update()
 
+    @profiling.profiled
+    def compute(mean_image, thumbnails, threshold):
+        # bootstrap the size of the hot spot when the stack has more than one thumbnail,
+        # with a fixed seed so the same slider position always shows the same band
+        if interval and thumbnails is not None and len(thumbnails) > 1:
+            return mean_image, threshold, stacking.hotspot_size_interval(thumbnails, threshold, seed=0)
+        return mean_image, threshold, None
+
+    @profiling.profiled
+    def draw(result):
+        mean_image, threshold, size_interval = result
+        if interval:
+            shape = plot_fn(mean_image, threshold, size_interval)
+        else:
+            shape = plot_fn(mean_image, threshold)
+        with img:
+            img.clear_output(wait=True)
+            img_fn(mean_image, shape)
+
+    @profiling.profiled
     def update():
         if cmb_data.mean_image is None:
             with graph:
@@ -491,13 +620,10 @@ def averaged_hotspot_profile(plot_fn, img_fn, value):
                 display(label)
                 return
 
-        with graph:
-            graph.clear_output(wait=True)
-            threshold = slider.value / 100
-            shape = plot_fn(cmb_data.mean_image, threshold)
-        with img:
-            img.clear_output(wait=True)
-            img_fn(cmb_data.mean_image, shape)
+        # only the latest slider position gets drawn
+        mean_image, thumbnails = cmb_data.mean_image, cmb_data.thumbnails
+        threshold = slider.value / 100
+        runner.run(lambda: compute(mean_image, thumbnails, threshold), draw)
 
     slider.observe(on_change, names='value')
 
@@ -516,7 +642,17 @@ def averaged_hotspot_horizontal_profile(value=20):
     averaged_hotspot_profile(plot.averaged_hotspot_horizontal_profile, plot.view_map_pixel, value)
 
 def averaged_hotspot_radial_profile(value=20):
-    averaged_hotspot_profile(plot.averaged_hotspot_radial_profile, plot.view_map_degrees, value)
+    averaged_hotspot_profile(plot.averaged_hotspot_radial_profile, plot.view_map_degrees, value, interval=True)
+
+def background_runner(output):
+    """
+    Runs heavy callbacks on a background thread, drawing only the latest result into
+    `output` and a placeholder while it takes long (see scheduler.LatestRunner).
+    """
+    def placeholder():
+        display(widgets.Label(value=i18n.gettext("computing_message")))
+
+    return scheduler.LatestRunner(output, placeholder)
 
 def set_widget_styles(list, description_width='initial', width=45):
     for widget in list: